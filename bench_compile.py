@@ -0,0 +1,112 @@
+"""
+eager vs torch.compile training step throughput, per target, on synthetic data
+one step is the train_hypergan step: D update on Q(s) codes, generate an
+ensemble, batched classifier loss, Q/G update
+
+    python3 bench_compile.py --targets small,lenet --steps 50
+"""
+import time
+import argparse
+import importlib
+
+import torch
+import torch.nn.functional as F
+
+import ops
+import utils
+import netdef
+
+
+def load_args():
+
+    parser = argparse.ArgumentParser(description='HyperGAN compile benchmark')
+    parser.add_argument('--z', default=64, type=int, help='Q(z|s) latent space width')
+    parser.add_argument('--s', default=256, type=int, help='S sample dimension')
+    parser.add_argument('--bias', action='store_true', help='Include HyperGAN bias')
+    parser.add_argument('--batch_size', default=32, type=int, help='network batch size')
+    parser.add_argument('--targets', default='small,lenet', type=str, help='comma separated target names')
+    parser.add_argument('--steps', default=50, type=int, help='timed steps per mode')
+    parser.add_argument('--warmup', default=3, type=int, help='untimed steps per mode (includes compilation)')
+    parser.add_argument('--netdef', action='store_true', help='build targets from their netdef.nets() ops')
+    parser.add_argument('--fused_gen', action='store_true', help='single fused generator for all layers')
+    parser.add_argument('--head_rank', default=0, type=int, help='low-rank generator output heads (0: full)')
+    parser.add_argument('--gen_chunk', default=0, type=int, help='shared chunked generator emitting chunks of this size (0: off)')
+    parser.add_argument('--compile_cache', default='.compile_cache', type=str, help='on-disk cache for compiled artifacts')
+    parser.add_argument('--threads', default=0, type=int, help='torch intra-op threads (0: default)')
+    args = parser.parse_args()
+    return args
+
+
+def build(args, target):
+    args.target = target
+    args.ngen = len(netdef.nets()[target]['shapes'])
+    args.torchscript = False
+    args.dataset = 'bench'
+    if args.netdef:
+        models = importlib.import_module('models.compiled')
+    else:
+        models = importlib.import_module('models.{}'.format(target))
+    torch.manual_seed(1)
+    hypergan = models.HyperGAN(args)
+    params = list(hypergan.mixer.parameters())
+    for gen in hypergan.generator.as_list():
+        params += list(gen.parameters())
+    optimQG = torch.optim.Adam(params, lr=1e-4, foreach=True)
+    optimD = torch.optim.Adam(hypergan.discriminator.parameters(), lr=1e-4)
+    return hypergan, optimQG, optimD
+
+
+def step(args, hypergan, optimQG, optimD, data, target, batched):
+    s = torch.randn(args.batch_size, args.s)
+    z = torch.randn(args.batch_size, args.z)
+    codes = hypergan.mixer(s)
+    d_loss, _ = ops.calc_d_loss(args, hypergan.discriminator, z, codes.detach())
+    optimD.zero_grad()
+    d_loss.backward()
+    with utils.frozen(hypergan.discriminator):
+        Q_loss = ops.calc_q_loss(args, hypergan.discriminator, codes)
+    params = hypergan.generator(codes)
+    if batched:
+        out = hypergan.eval_f_batched(args, params, data)
+        clf_loss, _ = ops.ensemble_clf_loss(out, target)
+    else:
+        clf_loss = 0.
+        for layers in zip(*params):
+            clf_loss += F.cross_entropy(hypergan.eval_f(args, layers, data), target)
+    (Q_loss + clf_loss / args.batch_size).backward()
+    optimD.step()
+    optimQG.step()
+    optimQG.zero_grad()
+
+
+def run(args, target, mode):
+    hypergan, optimQG, optimD = build(args, target)
+    if mode == 'compiled':
+        utils.compile_hypergan(args, hypergan, args.compile_cache)
+    input_shape = netdef.nets()[target]['input_shape']
+    data = torch.randn(args.batch_size, *input_shape)
+    labels = torch.randint(0, 10, (args.batch_size,))
+    batched = mode != 'eager'
+    start = time.perf_counter()
+    for _ in range(args.warmup):
+        step(args, hypergan, optimQG, optimD, data, labels, batched)
+    warmup = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        step(args, hypergan, optimQG, optimD, data, labels, batched)
+    return args.steps / (time.perf_counter() - start), warmup
+
+
+if __name__ == '__main__':
+    args = load_args()
+    args.device = 'cpu'
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    print ('{:<10}{:<12}{:>12}{:>12}{:>10}'.format('target', 'mode', 'steps/sec', 'warmup (s)', 'speedup'))
+    for target in args.targets.split(','):
+        base = None
+        for mode in ['eager', 'batched', 'compiled']:
+            rate, warmup = run(args, target, mode)
+            base = rate if base is None else base
+            print ('{:<10}{:<12}{:>12.2f}{:>12.2f}{:>9.2f}x'.format(
+                target, mode, rate, warmup, rate / base))
@@ -0,0 +1,187 @@
+import os
+import re
+import random
+import shutil
+import numpy as np
+import torch
+
+import utils
+
+
+"""
+one checkpoint format for model snapshots and full training state
+every file is a dict with a 'version' header and the module entries the
+models always used ('mixer', 'netD', 'W1'..'Wn', each {'state_dict': ...}),
+so model-only readers (restore_models, serve_hypergan) load either kind.
+training checkpoints add 'optimizers', 'schedulers', 'rng', 'position' and
+'best'. files are written to a temp name and renamed into place, and are
+loaded memory-mapped, so tensors are paged in as load_state_dict copies them
+"""
+FORMAT = 'hypergan'
+VERSION = 1
+PATTERN = re.compile(r'^ckpt-e(\d+)-b(\d+)\.pt$')
+
+
+def modules(hypergan):
+    """ the modules of a HyperGAN by checkpoint key """
+    entries = {'mixer': hypergan.mixer, 'netD': hypergan.discriminator}
+    for i, gen in enumerate(hypergan.generator.as_list()):
+        entries['W{}'.format(i+1)] = gen
+    return entries
+
+
+def model_state(hypergan):
+    return {k: {'state_dict': m.state_dict()} for k, m in modules(hypergan).items()}
+
+
+def load_model_state(hypergan, state):
+    for k, m in modules(hypergan).items():
+        m.load_state_dict(state[k]['state_dict'])
+
+
+def save_models(hypergan, path, worker=None):
+    """ model-only checkpoint; with a side-effect worker a CPU snapshot is serialized off the training thread """
+    state = model_state(hypergan)
+    if worker is not None:
+        worker.submit(save, path, utils.cpu_snapshot(state), key='checkpoint')
+        return path
+    return save(path, state)
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(),
+            'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save(path, state):
+    """ versioned, atomic: readers see the old file or the complete new one """
+    state = dict(state, format=FORMAT, version=VERSION)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def load(path, map_location='cpu'):
+    """ memory-mapped when the file allows it; pre-versioned files load as before """
+    try:
+        state = torch.load(path, map_location=map_location, mmap=True, weights_only=False)
+    except RuntimeError:
+        """ legacy (non-zip) serialization cannot be mapped """
+        state = torch.load(path, map_location=map_location, weights_only=False)
+    if state.get('version', 0) > VERSION:
+        raise ValueError('{} has checkpoint version {}, this code reads up to {}'.format(
+            path, state['version'], VERSION))
+    return state
+
+
+def training_state(hypergan, optimQ, optimD, optimW, schedulers, epoch, batch,
+        best, epoch_rng=None, global_step=0):
+    """
+    everything needed to continue a run; position is the next (epoch, batch)
+    to train and the optimizer steps taken so far, which set the checkpoint
+    cadence. mid-epoch, epoch_rng is the RNG state the epoch started from, so
+    the loader's shuffle order can be replayed
+    """
+    return dict(model_state(hypergan),
+            optimizers={'Q': optimQ.state_dict(), 'D': optimD.state_dict(),
+                'W': [optim.state_dict() for optim in optimW]},
+            schedulers=[scheduler.state_dict() for scheduler in schedulers],
+            rng=rng_state(),
+            epoch_rng=epoch_rng if batch > 0 else None,
+            position={'epoch': epoch, 'batch': batch, 'global_step': global_step},
+            best=dict(best))
+
+
+def load_training_state(state, hypergan, optimQ, optimD, optimW, schedulers):
+    """ restores modules, optimizers and schedulers; returns the full state for the rest """
+    if 'optimizers' not in state:
+        raise ValueError('checkpoint holds model weights only, it cannot resume training')
+    load_model_state(hypergan, state)
+    optimQ.load_state_dict(state['optimizers']['Q'])
+    optimD.load_state_dict(state['optimizers']['D'])
+    for optim, optim_state in zip(optimW, state['optimizers']['W']):
+        optim.load_state_dict(optim_state)
+    for scheduler, scheduler_state in zip(schedulers, state['schedulers']):
+        scheduler.load_state_dict(scheduler_state)
+    return state
+
+
+"""
+periodic training checkpoints in one directory: ckpt-e{epoch}-b{batch}.pt,
+the newest keep_last are kept, best.pt is a hard link (or copy) of the
+checkpoint written with best=True. writes can go to a side-effect worker,
+the state handed over must then be a CPU snapshot
+"""
+class CheckpointManager(object):
+    def __init__(self, directory, keep_last=3, worker=None):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.worker = worker
+
+    def checkpoints(self):
+        """ (epoch, batch, path), oldest first """
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for name in os.listdir(self.directory):
+            match = PATTERN.match(name)
+            if match:
+                found.append((int(match.group(1)), int(match.group(2)),
+                    os.path.join(self.directory, name)))
+        return sorted(found)
+
+    def latest(self):
+        found = self.checkpoints()
+        return found[-1][2] if found else None
+
+    def save(self, state, best=False):
+        position = state['position']
+        path = os.path.join(self.directory, 'ckpt-e{:06d}-b{:06d}.pt'.format(
+            position['epoch'], position['batch']))
+        if self.worker is None:
+            return self.write(path, state, best)
+        self.worker.submit(self.write, path, utils.cpu_snapshot(state), best,
+                key='resume-best' if best else 'resume')
+        return path
+
+    def write(self, path, state, best=False):
+        save(path, state)
+        if best:
+            best_path = os.path.join(self.directory, 'best.pt')
+            tmp = '{}.{}.tmp'.format(best_path, os.getpid())
+            try:
+                os.link(path, tmp)
+            except OSError:
+                shutil.copyfile(path, tmp)
+            os.replace(tmp, best_path)
+        for _, _, old in self.checkpoints()[:-self.keep_last]:
+            os.remove(old)
+        return path
+
+
+def resolve(path):
+    """ --resume may name a checkpoint file or a checkpoint directory (its latest) """
+    if os.path.isdir(path):
+        latest = CheckpointManager(path).latest()
+        if latest is None:
+            raise ValueError('no checkpoints in {}'.format(path))
+        return latest
+    return path
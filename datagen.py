@@ -1,12 +1,191 @@
+import os
+import copy
+import itertools
+import numpy as np
 import torch
 import torchvision
 from torchvision import datasets, transforms
 
 
-def load_mnist():
+"""
+in-memory loader: the dataset is decoded once into a uint8 tensor on the
+target device and normalized on the fly per batch, batches are taken by
+index slicing, so there are no worker processes and no PIL in the loop
+iterates like a DataLoader and exposes .dataset for len()
+"""
+class TensorLoader(object):
+    def __init__(self, data, targets, mean, std, batch_size, shuffle=False,
+            drop_last=False, device='cpu', normalize_once=False):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.device = device
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1).to(device)
+        self.std = torch.tensor(std).view(1, -1, 1, 1).to(device)
+        self.data = data.contiguous().to(device)
+        self.targets = targets.to(device)
+        self.normalized = normalize_once
+        self.start = 0
+        if normalize_once:
+            self.data = self.normalize(self.data)
+        self.dataset = torch.utils.data.TensorDataset(self.data, self.targets)
+
+    def normalize(self, x):
+        return x.float().div_(255.).sub_(self.mean).div_(self.std)
+
+    def __len__(self):
+        n = len(self.targets)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.targets)
+        order = None
+        if self.shuffle:
+            order = torch.randperm(n, device=self.device)
+        for i in range(self.start, len(self)):
+            start, end = i * self.batch_size, min((i+1) * self.batch_size, n)
+            if order is None:
+                data, target = self.data[start:end], self.targets[start:end]
+            else:
+                idx = order[start:end]
+                data, target = self.data[idx], self.targets[idx]
+            if not self.normalized:
+                data = self.normalize(data)
+            yield data, target
+
+
+def to_tensor_loader(dataset, mean, std, batch_size, shuffle, drop_last, device='cpu'):
+    """ raw uint8 images and labels straight from a torchvision dataset """
+    data = dataset.data
+    if not torch.is_tensor(data):
+        data = torch.from_numpy(data)
+    if data.dim() == 3:
+        data = data.unsqueeze(1)
+    else:
+        data = data.permute(0, 3, 1, 2)
+    targets = torch.as_tensor(dataset.targets, dtype=torch.long)
+    return TensorLoader(data, targets, mean, std, batch_size, shuffle=shuffle,
+            drop_last=drop_last, device=device)
+
+
+class Rebatched(object):
+    """ regroups the batches of any loader into fixed-size ones, the remainder is dropped """
+    def __init__(self, loader, batch_size):
+        self.loader = loader
+        self.batch_size = batch_size
+        self.dataset = loader.dataset
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.dataset) // self.batch_size
+
+    def __iter__(self):
+        data, targets, n = [], [], 0
+        drop = self.offset
+        for x, y in self.loader:
+            if drop > 0:
+                x, y, drop = x[drop:], y[drop:], max(drop - x.size(0), 0)
+            data.append(x)
+            targets.append(y)
+            n += x.size(0)
+            while n >= self.batch_size:
+                x, y = torch.cat(data), torch.cat(targets)
+                yield x[:self.batch_size], y[:self.batch_size]
+                data, targets = [x[self.batch_size:]], [y[self.batch_size:]]
+                n -= self.batch_size
+
+
+def rebatch(loader, batch_size):
+    """ same data in batches of batch_size; in-memory loaders just slice differently """
+    if isinstance(loader, TensorLoader):
+        loader.batch_size = batch_size
+        loader.drop_last = True
+        return loader
+    return Rebatched(loader, batch_size)
+
+
+class SkippedBatches(object):
+    """ a batch sampler without its first start batches; their indices are drawn, never loaded """
+    def __init__(self, batch_sampler, start):
+        self.batch_sampler = batch_sampler
+        self.start = start
+
+    def __len__(self):
+        return max(len(self.batch_sampler) - self.start, 0)
+
+    def __iter__(self):
+        batches = iter(self.batch_sampler)
+        for _ in range(self.start):
+            next(batches, None)
+        for batch in batches:
+            yield batch
+
+
+def skipped(loader, start):
+    """ loader without its first start batches, same shuffle draws as a fresh iteration """
+    if isinstance(loader, TensorLoader):
+        loader = copy.copy(loader)
+        loader.start = start
+        return loader
+    if isinstance(loader, Rebatched):
+        inner, offset = divmod(start * loader.batch_size, loader.loader.batch_size)
+        loader = copy.copy(loader)
+        loader.loader, loader.offset = skipped(loader.loader, inner), offset
+        return loader
+    kwargs = {}
+    if loader.num_workers > 0:
+        kwargs = {'prefetch_factor': loader.prefetch_factor,
+                'persistent_workers': loader.persistent_workers}
+    return torch.utils.data.DataLoader(loader.dataset,
+            batch_sampler=SkippedBatches(loader.batch_sampler, start),
+            num_workers=loader.num_workers, collate_fn=loader.collate_fn,
+            pin_memory=loader.pin_memory, timeout=loader.timeout,
+            worker_init_fn=loader.worker_init_fn,
+            multiprocessing_context=loader.multiprocessing_context,
+            generator=loader.generator, **kwargs)
+
+
+def skip_batches(loader, start):
+    """
+    iterator over the batches of loader from batch start on, for resuming mid
+    epoch. the skipped batches are never loaded: only their indices are drawn,
+    so the shuffle order matches an iteration started from the same RNG state.
+    the first batch is fetched here, the order is fixed before returning
+    """
+    batches = iter(skipped(loader, start))
+    first = next(batches, None)
+    if first is None:
+        return batches
+    return itertools.chain([first], batches)
+
+
+def random_subset(loader, n):
+    """ a loader over n examples of loader.dataset drawn without replacement, same batch size """
+    index = torch.randperm(len(loader.dataset))[:n]
+    if isinstance(loader, TensorLoader):
+        index = index.to(loader.device)
+        subset = copy.copy(loader)
+        subset.data, subset.targets = loader.data[index], loader.targets[index]
+        subset.dataset = torch.utils.data.TensorDataset(subset.data, subset.targets)
+        subset.shuffle, subset.drop_last = False, False
+        return subset
+    return torch.utils.data.DataLoader(torch.utils.data.Subset(loader.dataset, index.tolist()),
+            batch_size=loader.batch_size, num_workers=loader.num_workers,
+            pin_memory=loader.pin_memory)
+
+
+def load_mnist(in_memory=False, device='cpu'):
     torch.cuda.manual_seed(1)
     kwargs = {'num_workers': 1, 'pin_memory': True, 'drop_last': False}
     path = 'data_m/'
+    if in_memory:
+        norm = ((0.1307,), (0.3081,))
+        trainset = datasets.MNIST(path, train=True, download=True)
+        testset = datasets.MNIST(path, train=False)
+        return (to_tensor_loader(trainset, *norm, 100, False, False, device),
+                to_tensor_loader(testset, *norm, 100, False, False, device))
     train_loader = torch.utils.data.DataLoader(
             datasets.MNIST(path, train=True, download=True,
                 transform=transforms.Compose([
@@ -24,10 +203,16 @@ def load_mnist():
     return train_loader, test_loader
 
 
-def load_notmnist():
+def load_notmnist(in_memory=False, device='cpu'):
     torch.cuda.manual_seed(1)
     kwargs = {'num_workers': 1, 'pin_memory': True, 'drop_last': False}
     path = 'data_nm/'
+    if in_memory:
+        norm = ((0.1307,), (0.3081,))
+        trainset = datasets.MNIST(path, train=True)
+        testset = datasets.MNIST(path, train=False)
+        return (to_tensor_loader(trainset, *norm, 32, True, False, device),
+                to_tensor_loader(testset, *norm, 100, False, False, device))
     train_loader = torch.utils.data.DataLoader(
             datasets.MNIST(path, train=True,
                 transform=transforms.Compose([
@@ -44,10 +229,16 @@ def load_notmnist():
     return train_loader, test_loader
 
 
-def load_fashion_mnist():
+def load_fashion_mnist(in_memory=False, device='cpu'):
     path = 'data_f'
     torch.cuda.manual_seed(1)
     kwargs = {'num_workers': 1, 'pin_memory': True, 'drop_last': True}
+    if in_memory:
+        norm = ((0.1307,), (0.3081,))
+        trainset = datasets.FashionMNIST(path, train=True, download=True)
+        testset = datasets.FashionMNIST(path, train=False, download=True)
+        return (to_tensor_loader(trainset, *norm, 32, True, True, device),
+                to_tensor_loader(testset, *norm, 100, False, True, device))
     train_loader = torch.utils.data.DataLoader(
             datasets.FashionMNIST(path, train=True, download=True,
                 transform=transforms.Compose([
@@ -65,9 +256,15 @@ def load_fashion_mnist():
     return train_loader, test_loader
 
 
-def load_cifar():
+def load_cifar(in_memory=False, device='cpu'):
     path = 'data_c/'
     kwargs = {'num_workers': 1, 'pin_memory': True, 'drop_last': True}
+    if in_memory:
+        norm = ((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))
+        trainset = torchvision.datasets.CIFAR10(root=path, train=True, download=True)
+        testset = torchvision.datasets.CIFAR10(root=path, train=False, download=True)
+        return (to_tensor_loader(trainset, *norm, 32, True, True, device),
+                to_tensor_loader(testset, *norm, 100, False, True, device))
     transform_train = transforms.Compose([
         transforms.ToTensor(),
         transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
@@ -87,33 +284,61 @@ def load_cifar():
     return trainloader, testloader
 
 
-def load_cifar_hidden(c_idx=[0,1,2,3,4]):
+def class_subset_index(dataset, classes, split, root):
+    """
+    indices of samples whose label is in classes, from the raw label array
+    cached on disk keyed by split, class list and dataset size
+    """
+    labels = np.asarray(dataset.targets)
+    key = '{}-{}-n{}'.format(split, '_'.join(str(c) for c in sorted(classes)), len(labels))
+    cache = os.path.join(root, 'subset-{}.npy'.format(key))
+    if os.path.exists(cache):
+        return np.load(cache)
+    index = np.nonzero(np.isin(labels, list(classes)))[0]
+    try:
+        np.save(cache, index)
+    except OSError:
+        pass
+    return index
+
+
+def load_cifar_hidden(c_idx=[0,1,2,3,4], test_idx=None, in_memory=False, device='cpu'):
+    """ train on classes c_idx, test on test_idx (defaults to c_idx, others give OOD sets) """
     path = './data_c'
     kwargs = {'num_workers': 2, 'pin_memory': True, 'drop_last': True}
+    test_idx = c_idx if test_idx is None else test_idx
+    norm = ((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010))
+    if in_memory:
+        loaders = []
+        for split, classes, batch_size, shuffle in [
+                ('train', c_idx, 32, True), ('test', test_idx, 100, False)]:
+            dataset = torchvision.datasets.CIFAR10(root=path, train=split == 'train',
+                    download=False)
+            loader = to_tensor_loader(dataset, *norm, batch_size, shuffle, True)
+            index = torch.from_numpy(class_subset_index(dataset, classes, split, path))
+            loaders.append(TensorLoader(loader.data[index], loader.targets[index], *norm,
+                batch_size, shuffle=shuffle, drop_last=True, device=device))
+        return tuple(loaders)
     transform_train = transforms.Compose([
         transforms.ToTensor(),
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
+        transforms.Normalize(*norm),
         ])  
     transform_test = transforms.Compose([
         transforms.ToTensor(),
-        transforms.Normalize((0.4914, 0.4822, 0.4465), (0.2023, 0.1994, 0.2010)),
+        transforms.Normalize(*norm),
         ])  
-    def get_classes(target, labels):
-        label_indices = []
-        for i in range(len(target)):
-            if target[i][1] in labels:
-                label_indices.append(i)
-        return label_indices
 
     trainset = torchvision.datasets.CIFAR10(root=path, train=True,
             download=False, transform=transform_train)
-    train_hidden = torch.utils.data.Subset(trainset, get_classes(trainset, c_idx))
+    train_hidden = torch.utils.data.Subset(trainset,
+            class_subset_index(trainset, c_idx, 'train', path))
     trainloader = torch.utils.data.DataLoader(train_hidden, batch_size=32,
             shuffle=True, **kwargs)
 
     testset = torchvision.datasets.CIFAR10(root=path, train=False,
             download=False, transform=transform_test)
-    test_hidden = torch.utils.data.Subset(testset, get_classes(testset, c_idx))
+    test_hidden = torch.utils.data.Subset(testset,
+            class_subset_index(testset, test_idx, 'test', path))
     testloader = torch.utils.data.DataLoader(test_hidden, batch_size=100,
             shuffle=False, **kwargs)
     return trainloader, testloader
@@ -0,0 +1,115 @@
+import math
+import time
+import importlib
+import torch
+from statistics import NormalDist
+
+import ops
+import utils
+import datagen
+import experiments
+
+
+"""
+budgeted evaluation: most epochs only score a random test subset, sized by a
+fixed sample count (--eval_samples) or so that evaluation stays near a given
+fraction of wall-clock (--eval_fraction). the estimate carries a normal
+confidence interval over examples; when its upper bound could still beat the
+best accuracy, the subset result is discarded and the full test set is run,
+so checkpoints are only ever decided on full evaluations
+"""
+class EvalScheduler(object):
+    def __init__(self, args, hypergan, testset, metrics):
+        self.args = args
+        self.hypergan = hypergan
+        self.testset = testset
+        self.metrics = metrics
+        self.samples = args.eval_samples
+        self.fraction = args.eval_fraction
+        self.z = NormalDist().inv_cdf(0.5 + args.eval_confidence / 2.)
+        self.total = len(testset.dataset)
+        self.rate = None
+        self.last = time.perf_counter()
+        self.eval_time = 0.
+        self.full_evals = 0
+        self.subset_evals = 0
+
+    def budget(self):
+        """ test examples for the next estimate, 0 means the full set """
+        if self.fraction > 0 and self.rate is not None:
+            train_time = time.perf_counter() - self.last
+            n = int(self.rate * train_time * self.fraction / (1. - self.fraction))
+            return max(n, self.samples)
+        return self.samples
+
+    def run(self, loader):
+        start = time.perf_counter()
+        with torch.no_grad():
+            stats = ops.evaluate_ensemble(self.args, self.hypergan, loader, self.metrics)
+        elapsed = time.perf_counter() - start
+        self.eval_time += elapsed
+        if stats['examples'] > 0:
+            self.rate = stats['examples'] / max(elapsed, 1e-6)
+        return stats
+
+    def interval(self, stats):
+        """ half widths, with the finite population correction for sampling without replacement """
+        n = stats['examples']
+        if n >= self.total or 'acc_std' not in stats:
+            return 0., 0.
+        scale = self.z * math.sqrt((self.total - n) / float(self.total - 1) / n)
+        return scale * stats['acc_std'], scale * stats['loss_std']
+
+    def __call__(self, best_acc):
+        """ stats of this evaluation; stats['full'] says if it may be used for checkpoints """
+        n = self.budget()
+        stats = None
+        if 0 < n < self.total:
+            self.subset_evals += 1
+            stats = self.run(datagen.random_subset(self.testset, n))
+            stats['acc_ci'], stats['loss_ci'] = self.interval(stats)
+            stats['full'] = False
+            if stats['acc'] + stats['acc_ci'] >= best_acc:
+                """ might be a new best, settle it on the whole test set """
+                stats = None
+        if stats is None:
+            self.full_evals += 1
+            stats = self.run(self.testset)
+            stats['acc_ci'], stats['loss_ci'], stats['full'] = 0., 0., True
+        self.last = time.perf_counter()
+        return stats
+
+
+"""
+evaluator run by workers.EvalProcess for train_hypergan: builds its own
+HyperGAN and test set, then for every snapshot does the full test pass,
+posterior sampling and best-checkpoint bookkeeping
+"""
+class SnapshotEvaluator(object):
+    def __init__(self, args):
+        torch.manual_seed(args.seed + 1)
+        if args.eval_threads > 0:
+            torch.set_num_threads(args.eval_threads)
+        if args.netdef:
+            models = importlib.import_module('models.compiled')
+        else:
+            models = importlib.import_module('models.{}'.format(args.target))
+        self.args = args
+        self.hypergan = models.HyperGAN(args)
+        _, self.testset = getattr(datagen, 'load_{}'.format(args.dataset))(**args.data_kwargs)
+        self.metrics = utils.EnsembleMetrics(args.device)
+        """ a resumed run starts from the best of its training state """
+        self.best_acc, self.best_loss = args.best_acc, args.best_loss
+
+    def __call__(self, epoch):
+        with torch.no_grad():
+            stats = ops.evaluate_ensemble(self.args, self.hypergan, self.testset, self.metrics)
+        stats['epoch'] = epoch
+        stats['best'] = stats['acc'] > self.best_acc
+        self.best_loss = min(self.best_loss, stats['loss'])
+        if stats['best']:
+            self.best_acc = stats['acc']
+            self.hypergan.save_models(self.args, stats['acc'])
+        stats['best_acc'], stats['best_loss'] = self.best_acc, self.best_loss
+        experiments.sample_weight_posteriors(self.args, self.hypergan, epoch)
+        return stats
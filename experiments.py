@@ -1,210 +1,162 @@
 import numpy as np
 import torch
-import matplotlib.pyplot as plt
-from time import sleep
-import seaborn as sns
+from matplotlib.figure import Figure
 
-""" 
+import netdef
+
+"""
 we sample a collection of weights and graph their distribution
 weights can be sampled over individual neurons, layers, or everything
+statistics are streamed (Welford moments + fixed-range histograms), so memory
+does not grow with the size of the target or the number of samples
 """
-def sample_weight_posteriors_mednet(args, hypergan, epoch):
-    # collect 100 samples
-    n = 50
-    samples = 1
-    posterior = torch.zeros(n, samples*90506)
-    posterior_qz = torch.zeros(n, samples*args.z*args.ngen)
-    l1_z_posterior = torch.zeros(n, samples*args.z)
-    l2_z_posterior = torch.zeros(n, samples*args.z)
-    l3_z_posterior = torch.zeros(n, samples*args.z)
-    l4_z_posterior = torch.zeros(n, samples*args.z)
-    l5_z_posterior = torch.zeros(n, samples*args.z)
-    l1_posterior = torch.zeros(n, samples*32*3*3*3)
-    l2_posterior = torch.zeros(n, samples*32*64*3*3)
-    l3_posterior = torch.zeros(n, samples*64*64*3*3)
-    l4_posterior = torch.zeros(n, samples*256*128)
-    l5_posterior = torch.zeros(n, samples*128*10)
-    sample_neurons = [torch.zeros(n, samples) for _ in range(8)]
-    indexes = np.random.randint(1000, size=(8,))
-    for i in range(n):
-        s = torch.randn(args.batch_size, args.s).to(args.device)
-        z = torch.randn(args.batch_size, args.z).to(args.device)
-        codes = hypergan.mixer(s)
-        params = hypergan.generator(codes)
-        all_weights = torch.cat([x.contiguous()[:samples].view(-1) for x in params]).view(-1)
-        posterior[i] = all_weights
-        l1_posterior[i] = params[0].contiguous()[:samples].view(-1)
-        l2_posterior[i] = params[2].contiguous()[:samples].view(-1)
-        l3_posterior[i] = params[4].contiguous()[:samples].view(-1)
-        l4_posterior[i] = params[6].contiguous()[:samples].view(-1)
-        l5_posterior[i] = params[8].contiguous()[:samples].view(-1)
-        
-        l1_z_posterior[i] = codes[0][:samples].view(-1)
-        l2_z_posterior[i] = codes[1][:samples].view(-1)
-        l3_z_posterior[i] = codes[2][:samples].view(-1)
-        l4_z_posterior[i] = codes[3][:samples].view(-1)
-        l5_z_posterior[i] = codes[4][:samples].view(-1)
-        posterior_qz[i] = codes[:, :samples, :].contiguous().view(-1)
-        for j in range(8):
-            sample_neurons[j][i] = params[2].contiguous()[:samples].view(-1)[indexes[j]]
-
-    fig, ax = plt.subplots(4, 5, figsize=(30, 30))
-    # plot layer outputs
-    for i, item in enumerate([l1_posterior, l2_posterior, l3_posterior, l4_posterior, l5_posterior]):
-        sns.distplot(item.cpu().detach().view(-1), ax=ax[0, i])
-        ax[0, i].set_yticks([])
-        ax[0, i].set_title('Layer {}'.format(i))
-    # plot mixer outputs per layer
-    for i, item in enumerate([l1_z_posterior, l2_z_posterior, l3_z_posterior, l4_z_posterior, l5_z_posterior]):
-        sns.distplot(item.cpu().detach().view(-1), ax=ax[1, i])
-        ax[1, i].set_yticks([])
-        ax[1, i].set_title('Q(s)-{}'.format(i))
-    # plot all weights
-    sns.distplot(posterior.cpu().detach().view(-1), ax=ax[2,0])
-    ax[2, 0].set_yticks([])
-    ax[2, 0].set_title('Full G(z)')
-    # plot aggregated Q(s)
-    sns.distplot(posterior_qz.cpu().detach().view(-1), ax=ax[2,1])
-    ax[2, 1].set_yticks([])
-    ax[2, 1].set_title('Full Q(s)')
-    # plot individual neurons
-    for i, item in enumerate(sample_neurons[:3]):
-        sns.distplot(item.cpu().detach().view(-1), ax=ax[2,i+2])
-        ax[2, i+2].set_yticks([])
-        ax[2, i+2].set_title('Neuron-{}'.format(indexes[i]))
-    for i, item in enumerate(sample_neurons[3:]):
-        sns.distplot(item.cpu().detach().view(-1), ax=ax[3,i])
-        ax[3, i].set_yticks([])
-        ax[3, i].set_title('Neuron-{}'.format(indexes[i]+3))
-
-    plt.savefig('mednet-weight-posterior-epoch-{}'.format(epoch))
-    plt.close('all')
-    #plt.show()
-
-def sample_weight_posteriors_small(args, hypergan, epoch):
-    # collect 100 samples
-    n = 50
-    samples = 1
-    posterior = torch.zeros(n, samples*31594)
-    posterior_qz = torch.zeros(n, samples*args.z*args.ngen)
-    l1_z_posterior = torch.zeros(n, samples*args.z)
-    l2_z_posterior = torch.zeros(n, samples*args.z)
-    l3_z_posterior = torch.zeros(n, samples*args.z)
-    l1_posterior = torch.zeros(n, samples*32*1*5*5)
-    l2_posterior = torch.zeros(n, samples*32*32*5*5)
-    l3_posterior = torch.zeros(n, samples*512*10)
-    sample1 = torch.zeros(n, samples)
-    sample2 = torch.zeros(n, samples)
-    sample3 = torch.zeros(n, samples)
-    sample4 = torch.zeros(n, samples)
-    for i in range(n):
-        s = torch.randn(args.batch_size, args.s).to(args.device)
-        z = torch.randn(args.batch_size, args.z).to(args.device)
-        codes = hypergan.mixer(s)
-        params = hypergan.generator(codes)
-        all_weights = torch.cat([x.contiguous()[:samples].view(-1) for x in params]).view(-1)
-        posterior[i] = all_weights
-
-        l1_posterior[i] = params[0].contiguous()[:samples].view(-1)
-        l2_posterior[i] = params[2].contiguous()[:samples].view(-1)
-        l3_posterior[i] = params[4].contiguous()[:samples].view(-1)
-
-        l1_z_posterior[i] = codes[0][:samples].view(-1)
-        l2_z_posterior[i] = codes[1][:samples].view(-1)
-        l3_z_posterior[i] = codes[2][:samples].view(-1)
-        posterior_qz[i] = codes[:, :samples, :].contiguous().view(-1)
-
-        sample1[i] = params[2].contiguous()[:samples].view(-1)[10]
-        sample2[i] = params[2].contiguous()[:samples].view(-1)[50]
-        sample3[i] = params[2].contiguous()[:samples].view(-1)[100]
-        sample4[i] = params[2].contiguous()[:samples].view(-1)[300]
-
-    fig, ax = plt.subplots(4, 3, figsize=(30, 30))
-    # plot layer outputs
-    for i, item in enumerate([l1_posterior, l2_posterior, l3_posterior]):
-        sns.distplot(item.cpu().detach().view(-1), ax=ax[0, i])
-        ax[0, i].set_yticks([])
-        ax[0, i].set_title('Layer {}'.format(i))
-    # plot mixer outputs per layer
-    for i, item in enumerate([l1_z_posterior, l2_z_posterior, l3_z_posterior]):
-        sns.distplot(item.cpu().detach().view(-1), ax=ax[1, i])
-        ax[1, i].set_yticks([])
-        ax[1, i].set_title('Q(s)-{}'.format(i))
-    # plot all weights
-    sns.distplot(posterior.cpu().detach().view(-1), ax=ax[2,0])
-    ax[2, 0].set_yticks([])
-    ax[2, 0].set_title('Full G(z)')
-    # plot aggregated Q(s)
-    sns.distplot(posterior_qz.cpu().detach().view(-1), ax=ax[2,1])
-    ax[2, 1].set_yticks([])
-    ax[2, 1].set_title('Full Q(s)')
-    # plot individual neurons
-    sns.distplot(sample1.cpu().detach().view(-1), ax=ax[2,2])
-    ax[2, 2].set_yticks([])
-    ax[2, 2].set_title('Neuron 1')
-    for i, item in enumerate([sample2, sample3, sample4]):
-        sns.distplot(item.cpu().detach().view(-1), ax=ax[3,i])
-        ax[3, i].set_yticks([])
-        ax[3, i].set_title('Neuron-{}'.format(i+1))
-
-    plt.savefig('small-weight-posterior-epoch-{}'.format(epoch))
-    plt.close('all')
-    #plt.show()
-
-
-def sample_weight_posteriors_lenet(args, hypergan, epoch):
-    # collect 100 samples
-    n = 25
-    posterior = torch.zeros(100, 31594)
-    posterior_qz = torch.zeros(100, args.z*args.ngen)
-    l1_z_posterior = torch.zeros(100, args.z)
-    l2_z_posterior = torch.zeros(100, args.z)
-    l3_z_posterior = torch.zeros(100, args.z)
-    l4_z_posterior = torch.zeros(100, args.z)
-    l5_z_posterior = torch.zeros(100, args.z)
-    l1_posterior = torch.zeros(100, 32*1*5*5)
-    l2_posterior = torch.zeros(100, 32*32*5*5)
-    l3_posterior = torch.zeros(100, 512*10)
-    l4_posterior = torch.zeros(100, 512*10)
-    l5_posterior = torch.zeros(100, 512*10)
-    for i in range(n):
-        s = torch.randn(args.batch_size, args.s).to(args.device)
-        z = torch.randn(args.batch_size, args.z).to(args.device)
-        codes = hypergan.mixer(s)
-        params = hypergan.generator(codes)
-        all_weights = torch.stack(params).view(-1)
-
-        l1_posterior[i] = params[0].view(-1)
-        l2_posterior[i] = params[2].view(-1)
-        l3_posterior[i] = params[4].view(-1)
-        l4_posterior[i] = params[6].view(-1)
-        l5_posterior[i] = params[8].view(-1)
-        
-        l1_z_posterior[i] = codes[0]
-        l2_z_posterior[i] = codes[1]
-        l3_z_posterior[i] = codes[2]
-        l4_z_posterior[i] = codes[3]
-        l5_z_posterior[i] = codes[4]
-
-    fig, ax = plt.subplots(3, 5, figsize=(40, 40))
+class StreamingStats(object):
+    def __init__(self, bins=100):
+        self.bins = bins
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = np.inf
+        self.max = -np.inf
+        self.hist = None
+        self.edges = None
+
+    def update(self, x):
+        x = x.detach().reshape(-1).double()
+        n_b = x.numel()
+        if n_b == 0:
+            return
+        mean_b = x.mean().item()
+        m2_b = (x - mean_b).pow(2).sum().item()
+        lo, hi = x.min().item(), x.max().item()
+        """ Chan et al. parallel merge of (n, mean, M2) """
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * n_b / n
+        self.m2 += m2_b + delta**2 * self.n * n_b / n
+        self.n = n
+        self.min, self.max = min(self.min, lo), max(self.max, hi)
+        if self.hist is None:
+            """ histogram range is fixed by the first batch, tails land in the edge bins """
+            pad = max(0.1 * (hi - lo), 1e-3)
+            self.edges = np.linspace(lo - pad, hi + pad, self.bins + 1)
+            self.hist = np.zeros(self.bins, dtype=np.int64)
+        lo_e, hi_e = float(self.edges[0]), float(self.edges[-1])
+        counts = torch.histc(x.clamp(lo_e, hi_e), bins=self.bins, min=lo_e, max=hi_e)
+        self.hist += counts.cpu().numpy().astype(np.int64)
+
+    def summary(self):
+        var = self.m2 / max(self.n - 1, 1)
+        return {
+                'n': self.n,
+                'mean': self.mean,
+                'std': np.sqrt(var),
+                'min': self.min,
+                'max': self.max,
+                'hist': self.hist,
+                'edges': self.edges,
+                }
+
+
+def collect_weight_posteriors(args, hypergan, n=50, n_neurons=8, bins=100):
+    """
+    sample n members, accumulate per-layer, per Q(s) code and per-neuron stats
+    only the n members that are summarized are ever generated
+    """
+    net = netdef.nets()[hypergan.model_arch]
+    n_layers = len(net['shapes'])
+    layer_stats = [StreamingStats(bins) for _ in range(n_layers)]
+    code_stats = [StreamingStats(bins) for _ in range(n_layers)]
+    full_g, full_q = StreamingStats(bins), StreamingStats(bins)
+    """ track fixed neurons of the second layer so epochs are comparable """
+    n_w2 = int(np.prod(net['shapes'][1]))
+    indexes = np.random.RandomState(0).randint(n_w2, size=(n_neurons,))
+    neuron_stats = [StreamingStats(bins) for _ in range(n_neurons)]
+    chunk = max(min(args.batch_size, n), 2)
+    done = 0
+    with torch.no_grad():
+        while done < n:
+            k = min(chunk, n - done)
+            s = torch.randn(chunk, args.s).to(args.device)
+            codes = hypergan.mixer(s)
+            params = [p[:k] for p in hypergan.generator(codes)]
+            codes = codes[:, :k]
+            for i in range(n_layers):
+                layer_stats[i].update(params[2*i])
+                code_stats[i].update(codes[i])
+            for p in params:
+                full_g.update(p)
+            full_q.update(codes)
+            w2 = params[2].reshape(k, -1)
+            for j, idx in enumerate(indexes):
+                neuron_stats[j].update(w2[:, idx])
+            done += k
+    stats = {'layers': [st.summary() for st in layer_stats],
+             'codes': [st.summary() for st in code_stats],
+             'full_g': full_g.summary(),
+             'full_q': full_q.summary(),
+             'neurons': [st.summary() for st in neuron_stats],
+             'neuron_index': indexes,
+             'layer_names': net['layer_names']}
+    return stats
+
+
+def _plot_hist(ax, summary, title):
+    edges = summary['edges']
+    density = summary['hist'] / max(summary['n'] * (edges[1] - edges[0]), 1e-12)
+    ax.bar(edges[:-1], density, width=np.diff(edges), align='edge')
+    ax.set_yticks([])
+    ax.set_title(title)
+
+
+def plot_weight_posteriors(stats, path):
+    n_layers = len(stats['layers'])
+    n_neurons = len(stats['neurons'])
+    cols = max(n_layers, 3)
+    rows = 2 + int(np.ceil((2 + n_neurons) / cols))
+    """ no pyplot state, so this is safe to run on a background thread """
+    fig = Figure(figsize=(6*cols, 7.5*rows))
+    ax = fig.subplots(rows, cols, squeeze=False)
     # plot layer outputs
-    for i, item in enumerate([l1_posterior, l2_posterior, l2_posterior, l4_posterior, l5_posterior]):
-        sns.distplot(item.view(-1), ax=ax[0, i])
-        ax[0, i].set_yticks([])
-        ax[0, i].set_title('Layer {}'.format(i))
+    for i, item in enumerate(stats['layers']):
+        _plot_hist(ax[0, i], item, 'Layer {}'.format(i))
     # plot mixer outputs per layer
-    for i, item in enumerate([l1_z_posterior, l2_z_posterior, l3_z_posterior, l4_z_posterior, l5_z_posterior]):
-        sns.distplot(item.view(-1), ax=ax[1, i])
-        ax[1, i].set_yticks([])
-        ax[1, i].set_title('Q(s)-{}'.format(i))
-    # plot all weights
-    sns.distplot(posterior.view(-1), ax=[2,0])
-    ax[2, 0].set_yticks([])
-    ax[2, 0].set_title('Full G(z)')
-    # plot aggregated Q(s)
-    sns.distplot(posterior_qz.view(-1), ax=[2,1])
-    ax[2, 1].set_yticks([])
-    ax[2, 1].set_title('Full Q(s)')
-    plt.tight_layout()
-    plt.show()
+    for i, item in enumerate(stats['codes']):
+        _plot_hist(ax[1, i], item, 'Q(s)-{}'.format(i))
+    # plot all weights, aggregated Q(s) and individual neurons
+    panels = [(stats['full_g'], 'Full G(z)'), (stats['full_q'], 'Full Q(s)')]
+    panels += [(item, 'Neuron-{}'.format(idx))
+            for item, idx in zip(stats['neurons'], stats['neuron_index'])]
+    for k, (item, title) in enumerate(panels):
+        _plot_hist(ax[2 + k // cols, k % cols], item, title)
+    fig.savefig(path)
+
+
+def save_posterior_summary(stats, path):
+    """ compact .npz next to the figure: moments and histograms per panel """
+    arrays = {'neuron_index': stats['neuron_index'],
+              'layer_names': np.array(stats['layer_names'])}
+    named = [('full_g', stats['full_g']), ('full_q', stats['full_q'])]
+    named += [('layer{}'.format(i), s) for i, s in enumerate(stats['layers'])]
+    named += [('qs{}'.format(i), s) for i, s in enumerate(stats['codes'])]
+    named += [('neuron{}'.format(i), s) for i, s in enumerate(stats['neurons'])]
+    for name, summary in named:
+        for key, value in summary.items():
+            arrays['{}_{}'.format(name, key)] = np.asarray(value)
+    np.savez_compressed(path, **arrays)
+
+
+def write_weight_posteriors(stats, path):
+    plot_weight_posteriors(stats, path)
+    save_posterior_summary(stats, path + '.npz')
+
 
+def sample_weight_posteriors(args, hypergan, epoch, worker=None):
+    """ sampling stays on the caller, rendering can go to a side-effect worker """
+    stats = collect_weight_posteriors(args, hypergan)
+    path = '{}-weight-posterior-epoch-{}'.format(hypergan.model_arch, epoch)
+    if worker is not None:
+        worker.submit(write_weight_posteriors, stats, path, key='posterior')
+    else:
+        write_weight_posteriors(stats, path)
+    return stats
@@ -20,6 +20,7 @@ import ops
 import utils
 import netdef
 import datagen
+import workers
 
 
 def load_args():
@@ -31,13 +32,22 @@ def load_args():
     parser.add_argument('--target', default='mednet', type=str)
     parser.add_argument('--dataset', default='cifar', type=str)
     parser.add_argument('--beta', default=1., type=float)
+    parser.add_argument('--n_critic', default=1, type=int)
+    parser.add_argument('--log_interval', default=100, type=int)
     parser.add_argument('--exp', default='0', type=str)
     parser.add_argument('--model', default='full', type=str)
     parser.add_argument('--resume', default=False, type=bool)
     parser.add_argument('--pretrain_e', default=True, type=bool)
+    parser.add_argument('--pretrain_analytic', default=False, type=bool)
+    parser.add_argument('--pretrain_cache', default='saved_models/pretrain', type=str)
     parser.add_argument('--scratch', default=False, type=bool)
     parser.add_argument('--use_bn', default=True, type=bool)
     parser.add_argument('--bias', default=True, type=bool)
+    parser.add_argument('--batched_eval', default=False, type=bool)
+    parser.add_argument('--fused_gen', default=False, type=bool)
+    parser.add_argument('--head_rank', default=0, type=int)
+    parser.add_argument('--gen_chunk', default=0, type=int)
+    parser.add_argument('--async_eval', default=False, type=bool)
 
 
     args = parser.parse_args()
@@ -54,23 +64,62 @@ class HyperGANTrainer(object):
         self.use_bn = args.use_bn
         self.bias = args.bias
         self.pretrain_e = args.pretrain_e
+        self.batched_eval = args.batched_eval
+        self.n_critic = args.n_critic
+        self.log_interval = args.log_interval
+        self.async_eval = args.async_eval
+        self.pretrain_analytic = args.pretrain_analytic
+        self.pretrain_cache = args.pretrain_cache
+        self.seed = 8734
+        self.args = args
         self.device = torch.device('cuda')
-        torch.manual_seed(8734)        
+        torch.manual_seed(self.seed)        
 
         self.hypergan = HyperGAN(args, self.device)
         self.hypergan.print_hypergan()
         self.hypergan.attach_optimizers(5e-3, 1e-4, 5e-5)
 
-    def train_clf(self, params, data, target, val=False):
+    def train_clf(self, params, data, target):
         """ calc classifier loss """
-        data, target = data.cuda(), target.cuda()
         output = self.hypergan.eval_f(params, data)
         loss = F.cross_entropy(output, target)
-        correct = None
-        if val:
-            pred = output.data.max(1, keepdim=True)[1]
-            correct = pred.eq(target.data.view_as(pred)).float().cpu().sum()
-        return (correct, loss)
+        return (output, loss)
+
+    def train_clf_batched(self, params, data, target):
+        """ calc classifier loss for all members in one pass """
+        output = self.hypergan.eval_f_batched(params, data)
+        loss, correct = ops.ensemble_clf_loss(output, target)
+        return (output, correct, loss / output.size(0))
+
+    def clf_step(self, params, data, target, metrics):
+        """ mean member loss; accuracy goes to the on-device metrics, no host sync """
+        if self.batched_eval:
+            output, correct, loss = self.train_clf_batched(params, data, target)
+            metrics.update(output, target, loss * output.size(0), correct)
+            return loss
+        outputs, losses = [], []
+        for (layers) in zip(*params):
+            output, loss = self.train_clf(layers, data, target)
+            outputs.append(output.detach())
+            losses.append(loss)
+        loss = torch.stack(losses).mean()
+        metrics.update(torch.stack(outputs), target, loss * len(losses))
+        return loss
+
+    def d_loss(self, codes):
+        """ per-code D losses, prior samples and all codes in one forward """
+        ngen = codes.size(0)
+        noise = torch.randn(ngen, self.batch_size, self.z).cuda()
+        d_out = self.hypergan.discriminator(torch.cat([noise, codes]))
+        d_real, d_fake = d_out.view(2, ngen, -1).mean(2)
+        d_real_loss = -1 * torch.log(1-d_real).sum()
+        d_fake_loss = -1 * torch.log(d_fake).sum()
+        return d_real_loss + d_fake_loss
+
+    def q_loss(self, codes):
+        """ the mixer's fake-code term, call with the discriminator frozen """
+        d_fake = self.hypergan.discriminator(codes).view(codes.size(0), -1).mean(1)
+        return -1 * torch.log(d_fake).sum()
 
     def pretrain_loss(self, code, z):
         mean_z = torch.mean(z, dim=0, keepdim=True)
@@ -89,13 +138,19 @@ class HyperGANTrainer(object):
         e_batch_size = 1000
         for j in range(1000):
             x = torch.randn(e_batch_size, self.s).cuda()
-            z = torch.randn(e_batch_size, self.z).cuda()
             codes = self.hypergan.mixer(x)
-            for i, code in enumerate(codes):
-                code = code.view(e_batch_size, self.z)
-                mean_loss, cov_loss = self.pretrain_loss(code, z)
+            if self.pretrain_analytic:
+                # all codes against N(0, I) in one batched loss and one backward
+                mean_loss, cov_loss = ops.analytic_pretrain_loss(codes)
                 loss = mean_loss + cov_loss
-                loss.backward(retain_graph=True)
+                loss.backward()
+            else:
+                z = torch.randn(e_batch_size, self.z).cuda()
+                for i, code in enumerate(codes):
+                    code = code.view(e_batch_size, self.z)
+                    mean_loss, cov_loss = self.pretrain_loss(code, z)
+                    loss = mean_loss + cov_loss
+                    loss.backward(retain_graph=True)
             self.hypergan.optim_mixer.step()
             self.hypergan.mixer.zero_grad()
 
@@ -106,6 +161,27 @@ class HyperGANTrainer(object):
                 print ('Finished Pretraining Encoder')
                 break
         
+    def cached_pretrain_encoder(self):
+        """ reuse the pretrained mixer of an earlier launch with the same key """
+        ops.cached_pretrain_encoder(self.args, self.hypergan.mixer, self.hypergan.optim_mixer,
+                self.pretrain_cache, self.seed, self.pretrain_analytic, pretrain=self.pretrain_encoder)
+
+    def test(self, cifar_test, metrics):
+        """ one ensemble for the whole test set """
+        with torch.no_grad():
+            z = torch.randn(self.batch_size, self.s).cuda()
+            codes = self.hypergan.mixer(z)
+            params = self.hypergan.generator(codes)
+            for i, (data, target) in enumerate(cifar_test):
+                self.clf_step(params, data.cuda(), target.cuda(), metrics)
+        return metrics.summary()
+
+    def report(self, epoch, stats):
+        test_loss, test_acc = stats['loss'], stats['acc']
+        total_correct = test_acc * stats['examples']
+        print ('[Epoch {}] Test Loss: {}, Test Accuracy: {},  ({}/{}), Ensemble Accuracy: {}'.format(
+            epoch, test_loss, test_acc, total_correct, stats['examples'], stats['ensemble_acc']))
+
     def train(self):
         cifar_train, cifar_test = datagen.load_cifar()
         best_test_acc, best_test_loss = 0., np.inf
@@ -113,9 +189,14 @@ class HyperGANTrainer(object):
 
         one = torch.FloatTensor([1]).cuda()
         mone = (one * -1).cuda()
+        train_metrics = utils.EnsembleMetrics(self.device)
+        test_metrics = utils.EnsembleMetrics(self.device)
+        eval_process = None
+        if self.async_eval:
+            eval_process = workers.EvalProcess(self.args, SnapshotEvaluator, self.hypergan)
         if self.pretrain_e:
             print ("==> pretraining encoder")
-            self.pretrain_encoder()
+            self.cached_pretrain_encoder()
 
         print ('==> Begin Training')
         for epoch in range(1000):
@@ -125,79 +206,81 @@ class HyperGANTrainer(object):
                 params = self.hypergan.generator(codes)
                 
                 # Z Adversary
+                # D trains on detached codes; the mixer gets the same fake-code
+                # term through a frozen D, so everything is one backward below
+                for critic in range(self.n_critic - 1):
+                    d_loss = self.d_loss(codes.detach())
+                    d_loss.backward()
+                    self.hypergan.optim_disc.step()
+                    self.hypergan.discriminator.zero_grad()
+                d_loss = self.d_loss(codes.detach())
+                with utils.frozen(self.hypergan.discriminator):
+                    q_loss = self.q_loss(codes)
                 
-                for code in codes:
-                    noise = torch.randn(self.batch_size, self.z).cuda()
-                    d_real = self.hypergan.discriminator(noise)
-                    d_fake = self.hypergan.discriminator(code)
-                    d_real_loss = -1 * torch.log((1-d_real).mean())
-                    d_fake_loss = -1 * torch.log(d_fake.mean())
-                    d_real_loss.backward(retain_graph=True)
-                    d_fake_loss.backward(retain_graph=True)
-                    d_loss = d_real_loss + d_fake_loss
-                self.hypergan.optim_disc.step()
-                
-                d_loss = 0
-                losses, corrects = [], []
-                for (layers) in zip(*params):
-                    correct, loss = self.train_clf(layers, data, target, val=True)
-                    losses.append(loss)
-                    corrects.append(correct)
-                loss = torch.stack(losses).mean()
-                correct = torch.stack(corrects).mean()
+                data, target = data.cuda(), target.cuda()
+                loss = self.clf_step(params, data, target, train_metrics)
                 scaled_loss = self.beta * loss
-                scaled_loss.backward()
+                (d_loss + q_loss + scaled_loss).backward()
                    
+                self.hypergan.optim_disc.step()
                 self.hypergan.optim_mixer.step()
                 self.hypergan.update_generator()
                 self.hypergan.zero_grad()
                 
-                loss = loss.item()
-                
-                """ Update Statistics """
-                if batch_idx % 100 == 0:
-                    acc = (100* (correct / self.batch_size))
+                """ Update Statistics, the only host sync of the step """
+                if batch_idx % self.log_interval == 0:
+                    stats = train_metrics.summary()
+                    acc = 100 * stats['acc']
                     print ('**************************************')
                     print ('CIFAR Test, epoch: {}'.format(epoch))
-                    print ('Acc: {}, G Loss: {}, D Loss: {}'.format(acc, loss, d_loss))
+                    print ('Acc: {}, G Loss: {}, D Loss: {}'.format(acc, loss.item(), d_loss.item()))
                     print ('best test loss: {}'.format(self.best_loss))
                     print ('best test acc: {}'.format(self.best_acc))
                     print ('**************************************')
                 
-            with torch.no_grad():
-                test_acc = 0.
-                test_loss = 0.
-                total_correct = 0.
-                for i, (data, target) in enumerate(cifar_test):
-                    z = torch.randn(self.batch_size, self.s).cuda()
-                    codes = self.hypergan.mixer(z)
-                    params = self.hypergan.generator(codes)
-                    
-                    losses, corrects = [], []
-                    for (layers) in zip(*params):
-                        correct, loss = self.train_clf(layers, data, target, val=True)
-                        losses.append(loss)
-                        corrects.append(correct)
-                    losses = torch.stack(losses)
-                    corrects = torch.stack(corrects)
-                    test_acc += corrects.mean().item()
-                    total_correct += corrects.sum().item()
-                    test_loss += losses.mean().item()
-                test_loss /= len(cifar_test.dataset)
-                test_acc /= len(cifar_test.dataset)
-                total_correct /= self.batch_size
-                
-                print ('[Epoch {}] Test Loss: {}, Test Accuracy: {},  ({}/{})'.format(epoch, test_loss, test_acc,
-                    total_correct, len(cifar_test.dataset)))
+            if eval_process is not None:
+                """ the eval process tests this snapshot while we keep training """
+                eval_process.publish(self.hypergan, epoch)
+                for stats in eval_process.poll():
+                    self.report(stats['epoch'], stats)
+                    self.best_loss, self.best_acc = stats['best_loss'], stats['best_acc']
+                continue
+
+            stats = self.test(cifar_test, test_metrics)
+            test_loss, test_acc = stats['loss'], stats['acc']
+            self.report(epoch, stats)
+
+            if test_loss < best_test_loss or test_acc > best_test_acc:
+                print ('==> new best stats, saving')
+                if test_loss < best_test_loss:
+                    best_test_loss = test_loss
+                    self.best_loss = test_loss
+                if test_acc > best_test_acc:
+                    best_test_acc = test_acc
+                    self.best_acc = best_test_acc
+
+        if eval_process is not None:
+            for stats in eval_process.close():
+                self.report(stats['epoch'], stats)
+
+
+class SnapshotEvaluator(object):
+    """ eval process side of --async_eval: a trainer that only runs test passes """
+    def __init__(self, args):
+        self.trainer = HyperGANTrainer(args)
+        self.hypergan = self.trainer.hypergan
+        _, self.cifar_test = datagen.load_cifar()
+        self.metrics = utils.EnsembleMetrics(self.trainer.device)
+        self.best_acc, self.best_loss = 0., np.inf
 
-                if test_loss < best_test_loss or test_acc > best_test_acc:
-                    print ('==> new best stats, saving')
-                    if test_loss < best_test_loss:
-                        best_test_loss = test_loss
-                        self.best_loss = test_loss
-                    if test_acc > best_test_acc:
-                        best_test_acc = test_acc
-                        self.best_acc = best_test_acc
+    def __call__(self, epoch):
+        stats = self.trainer.test(self.cifar_test, self.metrics)
+        stats['epoch'] = epoch
+        stats['best'] = stats['acc'] > self.best_acc
+        self.best_acc = max(self.best_acc, stats['acc'])
+        self.best_loss = min(self.best_loss, stats['loss'])
+        stats['best_acc'], stats['best_loss'] = self.best_acc, self.best_loss
+        return stats
 
 
 if __name__ == '__main__':
@@ -208,6 +291,7 @@ if __name__ == '__main__':
     # log some of the netstat quantities so we don't subscript everywhere
     args.stat = modeldef
     args.shapes = modeldef['shapes']
+    args.ngen = len(args.shapes)
     args.lcd = modeldef['base_shape']
     # why is a running product so hard in python
     args.gcd = int(np.prod([*args.shapes[0]]))
@@ -0,0 +1,140 @@
+import json
+import struct
+import numpy as np
+import torch
+
+import netdef
+
+
+"""
+precomputed weight bank: N sampled members stored as one float32 [N, P] array
+each row is the flattened [w1, b1, w2, b2, ...] layout that eval_f expects
+file layout: magic | uint64 header length | json header | pad | rows
+the header carries the target description from netdef.nets()
+"""
+MAGIC = b'HGBANK01'
+VERSION = 1
+ALIGN = 64
+
+
+def layer_plan(shapes):
+    plan = []
+    offset = 0
+    for shape in shapes:
+        n_w = int(np.prod(shape))
+        plan.append((offset, n_w, shape[0], tuple(shape)))
+        offset += n_w + shape[0]
+    return plan, offset
+
+
+def write_header(f, target, n, n_params):
+    net = netdef.nets()[target]
+    header = {
+            'version': VERSION,
+            'target': target,
+            'name': net['name'],
+            'layer_names': net['layer_names'],
+            'shapes': [list(shape) for shape in net['shapes']],
+            'n': n,
+            'n_params': n_params,
+            'dtype': 'float32',
+            }
+    blob = json.dumps(header).encode('utf-8')
+    start = len(MAGIC) + 8 + len(blob)
+    offset = (start + ALIGN - 1) // ALIGN * ALIGN
+    header['offset'] = offset
+    blob = json.dumps(header).encode('utf-8')
+    """ the offset field may have grown the header, realign """
+    while len(MAGIC) + 8 + len(blob) > offset:
+        offset += ALIGN
+        header['offset'] = offset
+        blob = json.dumps(header).encode('utf-8')
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(blob)))
+    f.write(blob)
+    f.write(b'\0' * (offset - f.tell()))
+    return header
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError('{} is not a weight bank'.format(path))
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size).decode('utf-8'))
+    if header['version'] != VERSION:
+        raise ValueError('unsupported weight bank version {}'.format(header['version']))
+    return header
+
+
+class WeightBank(object):
+    """ lazily mapped bank, rows are paged in by the OS as they are indexed """
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self.target = self.header['target']
+        self.shapes = [tuple(shape) for shape in self.header['shapes']]
+        self.plan, n_params = layer_plan(self.shapes)
+        assert n_params == self.header['n_params']
+        """ copy-on-write map: zero-copy and writable, so torch does not warn """
+        self.data = np.memmap(path, dtype=np.float32, mode='c',
+                offset=self.header['offset'], shape=(self.header['n'], n_params))
+
+    def __len__(self):
+        return self.header['n']
+
+    def __getitem__(self, idx):
+        """ returns [w1, b1, w2, b2, ...] with a leading member dim """
+        return self.split(self.rows(idx))
+
+    def rows(self, idx):
+        """ the flat [members, n_params] rows, unsplit """
+        if isinstance(idx, int):
+            idx = slice(idx, idx+1)
+        return torch.from_numpy(self.data[idx])
+
+    def split(self, flat):
+        layers = []
+        for (offset, n_w, n_b, shape) in self.plan:
+            layers.append(flat[:, offset:offset+n_w].view(-1, *shape))
+            layers.append(flat[:, offset+n_w:offset+n_w+n_b])
+        return layers
+
+    def chunks(self, size, device='cpu'):
+        for i in range(0, len(self), size):
+            yield [p.to(device) for p in self[i:i+size]]
+
+
+def export_bank(hypergan, n, path, chunk_size=100):
+    """
+    sample n members through mixer and generator straight into the mapped file
+    layers are generated one at a time, so only one layer's weights are alive
+    """
+    mixer = hypergan.mixer
+    device = next(mixer.parameters()).device
+    plan, n_params = layer_plan(netdef.nets()[hypergan.model_arch]['shapes'])
+    chunk_size = max(chunk_size, 2)
+    with open(path, 'wb') as f:
+        header = write_header(f, hypergan.model_arch, n, n_params)
+        f.truncate(header['offset'] + n * n_params * 4)
+    rows = np.memmap(path, dtype=np.float32, mode='r+',
+            offset=header['offset'], shape=(n, n_params))
+    with torch.no_grad():
+        for start in range(0, n, chunk_size):
+            """ always sample a full chunk, BatchNorm needs more than one row """
+            k = min(chunk_size, n - start)
+            s = torch.randn(chunk_size, hypergan.sample_size).to(device)
+            codes = mixer(s)
+            for (offset, n_w, n_b, shape), (w, b) in zip(plan, hypergan.generator.stream(codes)):
+                assert tuple(w.shape[1:]) == shape, 'generator does not match netdef shapes'
+                layer = torch.cat([w[:k].reshape(k, -1), b[:k].reshape(k, -1)], 1)
+                rows[start:start+k, offset:offset+n_w+n_b] = layer.float().cpu().numpy()
+                del w, b, layer
+    rows.flush()
+    del rows
+    return header
+
+
+def load_bank(path):
+    return WeightBank(path)
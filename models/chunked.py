@@ -0,0 +1,84 @@
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import netdef
+
+
+"""
+chunked hypernetwork: one shared generator emits fixed-size chunks of the
+flattened (w, b) of every layer, conditioned on that layer's Q(s) code and a
+learned chunk embedding. Generator size grows with the chunk size, not with
+the parameter count of the target.
+exposes the same trunk/head/stream/split interface as FusedGenerator
+"""
+class ChunkedGenerator(nn.Module):
+    def __init__(self, args, shapes, chunk_size=4096, embed=64, act=F.relu, width=512):
+        super(ChunkedGenerator, self).__init__()
+        for k, v in vars(args).items():
+            setattr(self, k, v)
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.n_layers = len(self.shapes)
+        self.chunk_size = chunk_size
+        self.act = act
+        """ which layer every chunk belongs to, and each layer's chunk range """
+        self.plan, chunk_layer = [], []
+        for i, shape in enumerate(self.shapes):
+            n_w = int(np.prod(shape))
+            n_chunks = int(math.ceil((n_w + shape[0]) / float(chunk_size)))
+            start = len(chunk_layer)
+            self.plan.append((start, start + n_chunks, n_w, shape[0], shape))
+            chunk_layer.extend([i] * n_chunks)
+        self.n_chunks = len(chunk_layer)
+        self.register_buffer('chunk_layer', torch.tensor(chunk_layer, dtype=torch.long))
+        self.embedding = nn.Embedding(self.n_chunks, embed)
+        self.linear1 = nn.Linear(self.z + embed, width, bias=self.bias)
+        self.linear2 = nn.Linear(width, width, bias=self.bias)
+        self.linear3 = nn.Linear(width, chunk_size, bias=self.bias)
+        self.bn1 = nn.BatchNorm1d(width)
+        self.bn2 = nn.BatchNorm1d(width)
+
+    def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
+        """ x: [n_layers, N, z] codes -> [n_chunks, N, width] features """
+        if not self.bias:
+            self.bn1.bias.data.zero_()
+            self.bn2.bias.data.zero_()
+        x = torch.zeros_like(x).normal_(0, 0.01) + x
+        codes = x[self.chunk_layer]
+        emb = self.embedding.weight.unsqueeze(1).expand(-1, x.size(1), -1)
+        h = torch.cat([codes, emb], 2)
+        n_chunks, n = h.shape[:2]
+        h = h.reshape(n_chunks * n, -1)
+        h = self.act(self.bn1(self.linear1(h)))
+        h = self.act(self.bn2(self.linear2(h)))
+        return h.view(n_chunks, n, -1)
+
+    def layer(self, out, i):
+        """ out: [layer chunks, N, chunk_size] -> (w, b) of layer i """
+        _, _, n_w, n_b, shape = self.plan[i]
+        flat = out.transpose(0, 1).reshape(out.size(1), -1)
+        return flat[:, :n_w].view(-1, *shape), flat[:, n_w:n_w+n_b]
+
+    def head(self, h):
+        out = self.linear3(h)
+        layers = []
+        for i, (start, end, _, _, _) in enumerate(self.plan):
+            layers.extend(self.layer(out[start:end], i))
+        return layers
+
+    def stream(self, x):
+        """ yields (w, b) one layer at a time; one trunk pass, same noise draw as forward """
+        h = self.trunk(x)
+        for i, (start, end, _, _, _) in enumerate(self.plan):
+            yield self.layer(self.linear3(h[start:end]), i)
+
+
+def from_netdef(args, target=None, **kwargs):
+    target = args.target if target is None else target
+    shapes = netdef.nets()[target]['shapes']
+    return ChunkedGenerator(args, shapes, chunk_size=args.gen_chunk, **kwargs)
@@ -0,0 +1,263 @@
+import functools
+from typing import List
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import checkpoint
+import netdef
+from .hypergan_base import HyperGAN_Base, Generators
+from . import bank, layers
+
+
+"""
+target compiler: builds a HyperGAN straight from a netdef.nets() entry
+the entry's 'ops' describe every layer (conv/linear, stride, padding,
+activation, pooling, flatten); from them we get the mixer and discriminator
+sized by the layer count, the per-layer generators, the slicing plan of a flat
+[w1, b1, w2, b2, ...] row, and a batched functional forward that is emitted as
+straight-line source, so it runs eagerly, under torch.compile, or as
+TorchScript through torch.jit.CompilationUnit
+"""
+ACTS = {
+        None: '{}',
+        'relu': 'torch.relu({})',
+        'leaky_relu': 'torch.nn.functional.leaky_relu({})',
+        'elu': 'torch.nn.functional.elu({})',
+        'tanh': 'torch.tanh({})',
+        'sigmoid': 'torch.sigmoid({})',
+        }
+GENERATOR_ACTS = {'relu': F.relu, 'elu': F.elu, 'leaky_relu': F.leaky_relu}
+DEFAULTS = {'stride': 1, 'padding': 0, 'act': None, 'pool': 0, 'flatten': False}
+
+
+def layer_specs(target):
+    """ netdef ops with defaults filled in, checked against shapes and input_shape """
+    net = netdef.nets()[target]
+    if 'ops' not in net:
+        raise ValueError('netdef target {} has no ops description'.format(target))
+    if len(net['ops']) != len(net['shapes']):
+        raise ValueError('netdef target {}: {} ops for {} shapes'.format(
+            target, len(net['ops']), len(net['shapes'])))
+    specs = []
+    c, h, w = net['input_shape']
+    flat = False
+    for i, (op, shape) in enumerate(zip(net['ops'], net['shapes'])):
+        spec = dict(DEFAULTS, **op)
+        if spec['act'] not in ACTS:
+            raise ValueError('unknown activation {}'.format(spec['act']))
+        spec['shape'] = tuple(shape)
+        if spec['op'] == 'conv':
+            if flat or shape[1] != c:
+                raise ValueError('{} layer {}: expected {} input channels, got {}'.format(
+                    target, i, shape[1], c))
+            k = shape[2]
+            h = (h + 2*spec['padding'] - k) // spec['stride'] + 1
+            w = (w + 2*spec['padding'] - k) // spec['stride'] + 1
+            c = shape[0]
+            if spec['pool']:
+                h, w = h // spec['pool'], w // spec['pool']
+        elif spec['op'] == 'linear':
+            if spec['flatten'] or not flat:
+                c, flat = c * h * w, True
+                spec['flatten'] = True
+            if shape[1] != c:
+                raise ValueError('{} layer {}: expected {} input features, got {}'.format(
+                    target, i, shape[1], c))
+            c = shape[0]
+        else:
+            raise ValueError('unknown layer op {}'.format(spec['op']))
+        specs.append(spec)
+    return specs
+
+
+def emit_layer(i, spec, first):
+    """
+    source of one batched layer step (x, w, b) -> x
+    the first layer takes the data either shared by all members or sharded
+    """
+    lines = ['def layer{}(x: torch.Tensor, w: torch.Tensor, b: torch.Tensor) -> torch.Tensor:'.format(i),
+             '    m = w.size(0)']
+    shape = spec['shape']
+    if spec['op'] == 'conv':
+        """ members are stacked along channels: [B, M*C, H, W] """
+        groups = 'x.size(1) // {}'.format(shape[1]) if first else 'm'
+        lines.append('    x = torch.conv2d(x, w.reshape(m*{}, {}, {}, {}), b.reshape(-1), '
+                     '[{s}, {s}], [{p}, {p}], [1, 1], {g})'.format(
+                         *shape, s=spec['stride'], p=spec['padding'], g=groups))
+    else:
+        if spec['flatten'] and first:
+            """ [B, F] shared or [B, M*F] sharded input """
+            lines.append('    x = x.reshape(x.size(0), -1, {}).transpose(0, 1).expand(m, -1, -1)'.format(shape[1]))
+        elif spec['flatten']:
+            lines.append('    x = x.reshape(x.size(0), m, -1).transpose(0, 1)')
+        lines.append('    x = torch.baddbmm(b.unsqueeze(1), x, w.transpose(1, 2))')
+    if spec['act'] is not None:
+        lines.append('    x = ' + ACTS[spec['act']].format('x'))
+    if spec['pool']:
+        lines.append('    x = torch.max_pool2d(x, [{k}, {k}], [{k}, {k}])'.format(k=spec['pool']))
+    lines.append('    return x')
+    return '\n'.join(lines)
+
+
+def emit(specs, plan):
+    """
+    source of layer0..layerN, forward(data, params) and forward_flat(data, flat)
+    -> [members, batch, classes]; forward_flat slices [members, n_params] rows
+    at the plan's offsets, which are constants in the source
+    """
+    blocks = [emit_layer(i, spec, i == 0) for i, spec in enumerate(specs)]
+    lines = ['def forward(data: torch.Tensor, params: List[torch.Tensor]) -> torch.Tensor:',
+             '    x = data']
+    for i in range(len(specs)):
+        lines.append('    x = layer{i}(x, params[{w}], params[{b}])'.format(i=i, w=2*i, b=2*i+1))
+    lines.append('    return x')
+    blocks.append('\n'.join(lines))
+    lines = ['def forward_flat(data: torch.Tensor, flat: torch.Tensor) -> torch.Tensor:',
+             '    m = flat.size(0)',
+             '    x = data']
+    for i, (offset, n_w, n_b, shape) in enumerate(plan):
+        lines.append('    x = layer{i}(x, flat[:, {o}:{w}].reshape([m, {s}]), flat[:, {w}:{b}])'.format(
+            i=i, o=offset, w=offset+n_w, b=offset+n_w+n_b, s=', '.join(str(d) for d in shape)))
+    lines.append('    return x')
+    blocks.append('\n'.join(lines))
+    return '\n\n\n'.join(blocks) + '\n'
+
+
+class CompiledForward(object):
+    """ eager functions exec'd from the emitted source, plus a TorchScript twin on demand """
+    def __init__(self, specs):
+        self.plan, self.n_params = bank.layer_plan([spec['shape'] for spec in specs])
+        self.source = emit(specs, self.plan)
+        self.n_layers = len(specs)
+        namespace = {'torch': torch, 'List': List}
+        exec(compile(self.source, '<netdef forward>', 'exec'), namespace)
+        self.layers = [namespace['layer{}'.format(i)] for i in range(self.n_layers)]
+        self.forward = namespace['forward']
+        self.forward_flat = namespace['forward_flat']
+        self._scripted = None
+
+    def __call__(self, data, params):
+        return self.forward(data, list(params))
+
+    def script(self):
+        if self._scripted is None:
+            self._scripted = torch.jit.CompilationUnit(self.source)
+        return self._scripted
+
+
+class Mixer(nn.Module):
+    """ s -> one z-sized code per target layer, [n_codes, N, z] """
+    def __init__(self, args, n_codes):
+        super(Mixer, self).__init__()
+        for k, v in vars(args).items():
+            setattr(self, k, v)
+        self.n_codes = n_codes
+        self.linear1 = nn.Linear(self.s, 512, bias=self.bias)
+        self.linear2 = nn.Linear(512, 512, bias=self.bias)
+        self.linear3 = nn.Linear(512, self.z*n_codes, bias=self.bias)
+        self.bn1 = nn.BatchNorm1d(512)
+        self.bn2 = nn.BatchNorm1d(512)
+
+    def forward(self, x):
+        x = x.view(-1, self.s)
+        x = torch.zeros_like(x).normal_(0, 0.01) + x
+        x = F.relu(self.bn1(self.linear1(x)))
+        x = F.relu(self.bn2(self.linear2(x)))
+        x = self.linear3(x)
+        return x.view(-1, self.n_codes, self.z).transpose(0, 1).contiguous()
+
+
+class DiscriminatorZ(nn.Module):
+    """ scores single z-sized codes, shared by every layer """
+    def __init__(self, args):
+        super(DiscriminatorZ, self).__init__()
+        for k, v in vars(args).items():
+            setattr(self, k, v)
+        self.linear1 = nn.Linear(self.z, 512)
+        self.linear2 = nn.Linear(512, 512)
+        self.linear3 = nn.Linear(512, 1)
+
+    def forward(self, x):
+        x = x.view(-1, self.z)
+        x = F.relu(self.linear1(x))
+        x = F.relu(self.linear2(x))
+        return torch.sigmoid(self.linear3(x))
+
+
+class GeneratorW(nn.Module):
+    """ per-layer weight generator for any (w, b) shape """
+    def __init__(self, args, shape, act=F.relu):
+        super(GeneratorW, self).__init__()
+        for k, v in vars(args).items():
+            setattr(self, k, v)
+        self.shape = tuple(shape)
+        self.n_w = int(np.prod(shape))
+        self.n_b = shape[0]
+        self.act = act
+        self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
+        self.linear2 = nn.Linear(512, 512, bias=self.bias)
+        self.linear3 = layers.head(args, 512, self.n_w + self.n_b)
+        self.bn1 = nn.BatchNorm1d(512)
+        self.bn2 = nn.BatchNorm1d(512)
+
+    def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
+        if not self.bias:
+            self.bn1.bias.data.zero_()
+            self.bn2.bias.data.zero_()
+        x = torch.zeros_like(x).normal_(0, 0.01) + x
+        x = self.act(self.bn1(self.linear1(x)))
+        x = self.act(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
+        x = self.linear3(x)
+        w, b = x[:, :self.n_w], x[:, self.n_w:]
+        return (w.view(-1, *self.shape), b)
+
+
+class HyperGAN(HyperGAN_Base):
+
+    def __init__(self, args):
+        super(HyperGAN, self).__init__(args)
+        self.specs = layer_specs(args.target)
+        self.functional = CompiledForward(self.specs)
+        self.torchscript = args.torchscript
+        self.mixer = Mixer(args, len(self.specs)).to(args.device)
+        act = GENERATOR_ACTS[netdef.nets()[args.target].get('generator_act', 'relu')]
+        self.generator = Generators(args, [functools.partial(GeneratorW, shape=spec['shape'], act=act)
+            for spec in self.specs], act=act)
+        self.discriminator = DiscriminatorZ(args).to(args.device)
+
+    """ per-layer steps of the batched forward, each takes (x, w, b) """
+    def batched_layers(self, args):
+        return self.functional.layers
+
+    """ all members in one pass, returns [members, batch, classes] logits """
+    def eval_f_batched(self, args, Z, data):
+        if self.torchscript:
+            return self.functional.script().forward(data, list(Z))
+        return self.functional(data, Z)
+
+    """ all members of [members, n_params] flat rows (e.g. a weight bank), sliced by the plan """
+    def eval_f_flat(self, args, flat, data):
+        if self.torchscript:
+            return self.functional.script().forward_flat(data, flat)
+        return self.functional.forward_flat(data, flat)
+
+    """ functional model for training """
+    def eval_f(self, args, Z, data):
+        return self.eval_f_batched(args, [p.unsqueeze(0) for p in Z], data)[0]
+
+    def restore_models(self, args):
+        d = checkpoint.load(checkpoint.resolve(args.resume), map_location=args.device)
+        checkpoint.load_model_state(self, d)
+
+
+    def save_models(self, args, metrics=None, worker=None):
+        path = 'saved_models/{}/{}-netdef-{}-{}.pt'.format(
+                args.dataset, self.model_arch, args.exp, metrics)
+        checkpoint.save_models(self, path, worker)
@@ -0,0 +1,118 @@
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import netdef
+from . import layers
+
+
+"""
+all per-layer weight generators fused into one module
+the 512-512 trunks are stacked along a leading layer dim and run with bmm,
+BatchNorm runs once over the concatenated [N, L*512] features (per-channel
+stats, so identical to L separate BatchNorm1d(512)), and the output heads
+are written into one flat [N, total_params] buffer that is sliced into (w, b)
+"""
+class FusedGenerator(nn.Module):
+    def __init__(self, args, shapes, act=F.relu, noise=None, use_bn=True, width=512):
+        super(FusedGenerator, self).__init__()
+        for k, v in vars(args).items():
+            setattr(self, k, v)
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.n_layers = len(self.shapes)
+        self.width = width
+        self.act = act
+        self.use_bn = use_bn
+        self.weight1 = nn.Parameter(torch.empty(self.n_layers, self.z, width))
+        self.weight2 = nn.Parameter(torch.empty(self.n_layers, width, width))
+        if self.bias:
+            self.bias1 = nn.Parameter(torch.empty(self.n_layers, 1, width))
+            self.bias2 = nn.Parameter(torch.empty(self.n_layers, 1, width))
+        else:
+            self.register_parameter('bias1', None)
+            self.register_parameter('bias2', None)
+        if use_bn:
+            self.bn1 = nn.BatchNorm1d(self.n_layers*width)
+            self.bn2 = nn.BatchNorm1d(self.n_layers*width)
+        else:
+            self.bn1 = self.bn2 = None
+        """ output heads and the slicing plan for the flat buffer """
+        self.plan = []
+        offset = 0
+        for shape in self.shapes:
+            n_w = int(np.prod(shape))
+            self.plan.append((offset, n_w, shape[0], shape))
+            offset += n_w + shape[0]
+        self.n_params = offset
+        self.heads = nn.ModuleList([
+            layers.head(args, width, n_w+n_b) for (_, n_w, n_b, _) in self.plan])
+        if noise is None:
+            noise = [True] * self.n_layers
+        std = torch.tensor([0.01 if n else 0. for n in noise]).view(-1, 1, 1)
+        self.register_buffer('noise_std', std)
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        """ same init as the nn.Linear trunks this replaces """
+        for weight, bias in [(self.weight1, self.bias1), (self.weight2, self.bias2)]:
+            bound = 1. / math.sqrt(weight.size(1))
+            nn.init.uniform_(weight, -bound, bound)
+            if bias is not None:
+                nn.init.uniform_(bias, -bound, bound)
+
+    def _bn(self, bn, x):
+        if not self.use_bn:
+            return x
+        layers, n, width = x.shape
+        x = bn(x.transpose(0, 1).reshape(n, layers*width))
+        return x.view(n, layers, width).transpose(0, 1)
+
+    def _linear(self, x, weight, bias):
+        if bias is None:
+            return torch.bmm(x, weight)
+        return torch.baddbmm(bias, x, weight)
+
+    def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
+        if not self.bias and self.use_bn:
+            self.bn1.bias.data.zero_()
+            self.bn2.bias.data.zero_()
+        x = torch.randn_like(x) * self.noise_std + x
+        x = self.act(self._bn(self.bn1, self._linear(x, self.weight1, self.bias1)))
+        x = self.act(self._bn(self.bn2, self._linear(x, self.weight2, self.bias2)))
+        return x
+
+    def head(self, x):
+        flat = torch.cat([head(x[i]) for i, head in enumerate(self.heads)], 1)
+        return self.split(flat)
+
+    def stream(self, x):
+        """ yields (w, b) one layer at a time; one trunk pass, same noise draw as forward """
+        h = self.trunk(x)
+        for i in range(len(h)):
+            yield self.head_layer(h[i], i)
+
+    def head_layer(self, x, i):
+        """ (w, b) of layer i alone, from that layer's trunk features """
+        offset, n_w, n_b, shape = self.plan[i]
+        out = self.heads[i](x)
+        return out[:, :n_w].view(-1, *shape), out[:, n_w:]
+
+    def split(self, flat):
+        """ flat [N, n_params] -> [w1, b1, w2, b2, ...] views """
+        layers = []
+        for (offset, n_w, n_b, shape) in self.plan:
+            w = flat[:, offset:offset+n_w].view(-1, *shape)
+            b = flat[:, offset+n_w:offset+n_w+n_b]
+            layers.extend([w, b])
+        return layers
+
+
+def from_netdef(args, target=None, **kwargs):
+    target = args.target if target is None else target
+    shapes = netdef.nets()[target]['shapes']
+    return FusedGenerator(args, shapes, **kwargs)
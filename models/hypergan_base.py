@@ -1,5 +1,71 @@
 from abc import ABC, abstractmethod
 import torch.nn as nn
+import torch.nn.functional as F
+import utils
+import netdef
+from . import bank
+from . import fused
+from . import chunked
+
+
+"""
+the weight generators of a target: one module per layer (W1..Wn), or a single
+fused / chunked generator standing in for all of them. targets only pass their
+per-layer generator classes, trunk/head/stream dispatch lives here
+"""
+class Generators(object):
+    def __init__(self, args, per_layer, act=F.relu, target=None, device=None, **fused_kwargs):
+        device = args.device if device is None else device
+        self.fused = None
+        if args.fused_gen:
+            self.fused = fused.from_netdef(args, target, act=act, **fused_kwargs).to(device)
+            return
+        if args.gen_chunk > 0:
+            self.fused = chunked.from_netdef(args, target, act=act).to(device)
+            return
+        self.generators = [make(args).to(device) for make in per_layer]
+        for i, W in enumerate(self.generators):
+            setattr(self, 'W{}'.format(i+1), W)
+
+    def __call__(self, x):
+        if self.fused is not None:
+            return self.fused(x)
+        layers = []
+        for i, W in enumerate(self.generators):
+            layers.extend(W(x[i]))
+        return layers
+
+    def trunk(self, x):
+        """ per-layer features, BatchNorm sees every member """
+        if self.fused is not None:
+            return [self.fused.trunk(x)]
+        return [W.trunk(x[i]) for i, W in enumerate(self.generators)]
+
+    def head(self, h, idx=slice(None)):
+        """ weights for members idx from trunk features """
+        if self.fused is not None:
+            return self.fused.head(h[0][:, idx])
+        layers = []
+        for i, W in enumerate(self.generators):
+            layers.extend(W.head(h[i][idx]))
+        return layers
+
+    def stream(self, x):
+        """
+        yields (w, b) one layer at a time, drawing the trunk noise in the same
+        order as __call__, so both give the same weights from the same RNG state
+        """
+        if self.fused is not None:
+            yield from self.fused.stream(x)
+            return
+        for i, W in enumerate(self.generators):
+            yield W(x[i])
+
+    def as_list(self):
+        if self.fused is not None:
+            return [self.fused]
+        return list(self.generators)
+
 
 class HyperGAN_Base(ABC):
 
@@ -7,13 +73,10 @@ class HyperGAN_Base(ABC):
         self.model_arch = args.target
         self.sample_size = args.s
         self.latent_width = args.z
-        self.ngen = 3 if args.target == 'small' else 5
-        args.ensemble_size = args.batch_size
-
-    @abstractmethod
-    class Generator(object):
-        def __init__(self, args):
-            raise NotImplementedError
+        self.ngen = len(netdef.nets()[args.target]['shapes'])
+        if not getattr(args, 'ensemble_size', 0):
+            """ members per step default to one per data example, as before """
+            args.ensemble_size = args.batch_size
 
     @abstractmethod
     def eval_f(self, args):
@@ -26,6 +89,43 @@ class HyperGAN_Base(ABC):
     @abstractmethod
     def save_models(self, args):
         raise NotImplementedError
-            
 
-    
+    def run_layers(self, layers, Z, data):
+        """ batched forward through per-layer steps (x, w, b) -> x, Z is [w1, b1, w2, b2, ...] """
+        x = data
+        for i, layer in enumerate(layers):
+            x = layer(x, Z[2*i], Z[2*i+1])
+        return x
+
+    def eval_f_batched(self, args, Z, data):
+        """ all members in one pass, returns [members, batch, classes] logits """
+        return self.run_layers(self.batched_layers(args), Z, data)
+
+    def stream_layers(self, layers, codes, data):
+        """ generate layer k for all members, apply it, free it, move on """
+        x = data
+        for layer, (w, b) in zip(layers, self.generator.stream(codes)):
+            x = layer(x, w, b)
+            del w, b
+        return x
+
+    def eval_f_streamed(self, args, codes, data, seed=None):
+        """
+        eval_f_batched(generator(codes)) with peak memory of one layer
+        the generator trunks draw noise and use batch statistics on every call;
+        with a seed the noise is replayed from a forked RNG, so calls sharing a
+        seed (and codes) score the same ensemble
+        """
+        with utils.seeded(seed, codes.device):
+            return self.stream_layers(self.batched_layers(args), codes, data)
+
+    def export_bank(self, n, path, chunk_size=100):
+        """ sample n members once and write them to a memory-mapped bank """
+        return bank.export_bank(self, n, path, chunk_size)
+
+    def load_bank(self, path):
+        weight_bank = bank.load_bank(path)
+        if weight_bank.target != self.model_arch:
+            raise ValueError('bank {} holds {} members, not {}'.format(
+                path, weight_bank.target, self.model_arch))
+        return weight_bank
@@ -0,0 +1,34 @@
+import math
+import torch.nn as nn
+
+
+"""
+factorized output head for the weight generators
+the 512 -> n_params linear dominates generator FLOPs, parameters and Adam
+state; a rank-r factorization 512 -> r -> n_params cuts that by ~512/r
+"""
+class LowRankLinear(nn.Module):
+    def __init__(self, in_features, out_features, rank, bias=True):
+        super(LowRankLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.u = nn.Linear(in_features, rank, bias=False)
+        self.v = nn.Linear(rank, out_features, bias=bias)
+        """ default init shrinks the output by ~sqrt(3) per factor, undo one """
+        self.v.weight.data.mul_(math.sqrt(3))
+
+    def forward(self, x):
+        return self.v(self.u(x))
+
+    def extra_repr(self):
+        return 'in_features={}, out_features={}, rank={}'.format(
+            self.in_features, self.out_features, self.rank)
+
+
+def head(args, in_features, out_features):
+    """ full linear head, or a low-rank one when --head_rank is set and pays off """
+    rank = args.head_rank
+    if rank > 0 and rank * (in_features + out_features) < in_features * out_features:
+        return LowRankLinear(in_features, out_features, rank, bias=args.bias)
+    return nn.Linear(in_features, out_features, bias=args.bias)
@@ -1,7 +1,10 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .hypergan_base import HyperGAN_Base
+import ops
+import checkpoint
+from .hypergan_base import HyperGAN_Base, Generators
+from . import layers
 
 """ LeNet5 Pytorch definition """
 class LeNet(nn.Module):
@@ -52,17 +55,23 @@ class GeneratorW1(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 150 + 6, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 150 + 6)
         self.bn1 = nn.BatchNorm1d(512)
         self.bn2 = nn.BatchNorm1d(512)
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.relu(self.bn1(self.linear1(x)))
         x = F.relu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :150], x[:, -6:]
         w = w.view(-1, 6, 1, 5, 5)
@@ -77,17 +86,23 @@ class GeneratorW2(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 2400+16, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 2400+16)
         self.bn1 = nn.BatchNorm1d(512)
         self.bn2 = nn.BatchNorm1d(512)
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.relu(self.bn1(self.linear1(x)))
         x = F.relu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :2400], x[:, -16:]
         w = w.view(-1, 16, 6, 5, 5)
@@ -102,17 +117,23 @@ class GeneratorW3(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 120*400+120, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 120*400+120)
         self.bn1 = nn.BatchNorm1d(512)
         self.bn2 = nn.BatchNorm1d(512)
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.relu(self.bn1(self.linear1(x)))
         x = F.relu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :400*120], x[:, -120:]
         w = w.view(-1, 120, 400)
@@ -127,17 +148,23 @@ class GeneratorW4(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 84*120+84, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 84*120+84)
         self.bn1 = nn.BatchNorm1d(512)
         self.bn2 = nn.BatchNorm1d(512)
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.relu(self.bn1(self.linear1(x)))
         x = F.relu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :120*84], x[:, -84:]
         w = w.view(-1, 84, 120)
@@ -152,17 +179,23 @@ class GeneratorW5(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 10*84+10, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 10*84+10)
         self.bn1 = nn.BatchNorm1d(512)
         self.bn2 = nn.BatchNorm1d(512)
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.relu(self.bn1(self.linear1(x)))
         x = F.relu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :10*84], x[:, -10:]
         w = w.view(-1, 10, 84)
@@ -193,30 +226,10 @@ class HyperGAN(HyperGAN_Base):
     def __init__(self, args):
         super(HyperGAN, self).__init__(args)
         self.mixer = Mixer(args).to(args.device)
-        self.generator = self.Generator(args)
+        self.generator = Generators(args, [GeneratorW1, GeneratorW2, GeneratorW3, GeneratorW4, GeneratorW5], act=F.relu)
         self.discriminator = DiscriminatorZ(args).to(args.device)
         self.model = LeNet().to(args.device)
 
-    class Generator(object):
-        def __init__(self, args):
-            self.W1 = GeneratorW1(args).to(args.device)
-            self.W2 = GeneratorW2(args).to(args.device)
-            self.W3 = GeneratorW3(args).to(args.device)
-            self.W4 = GeneratorW4(args).to(args.device)
-            self.W5 = GeneratorW5(args).to(args.device)
-
-        def __call__(self, x):
-            w1, b1 = self.W1(x[0])
-            w2, b2 = self.W2(x[1])
-            w3, b3 = self.W3(x[2])
-            w4, b4 = self.W4(x[3])
-            w5, b5 = self.W5(x[4])
-            layers = [w1, b1, w2, b2, w3, b3, w4, b4, w5, b5]
-            return layers
-        
-        def as_list(self):
-            return [self.W1, self.W2, self.W3, self.W4, self.W5]
-
     """ functional model for training """
     def eval_f(self, args, Z, data):
         w1, b1, w2, b2, w3, b3, w4, b4, w5, b5 = Z
@@ -232,24 +245,28 @@ class HyperGAN(HyperGAN_Base):
         x = F.linear(x, w5, bias=b5)
         return x
 
+    """ per-layer steps of the batched forward, each takes (x, w, b) """
+    def batched_layers(self, args):
+        def conv1(x, w, b):
+            x = F.relu(ops.batched_conv2d(x, w, b, stride=1, padding=2))
+            return F.max_pool2d(x, 2, 2)
+        def conv2(x, w, b):
+            x = F.relu(ops.batched_conv2d(x, w, b, stride=1))
+            return F.max_pool2d(x, 2, 2)
+        def linear1(x, w, b):
+            x = ops.batched_flatten(x, w.size(0))
+            return F.relu(ops.batched_linear(x, w, b))
+        def linear2(x, w, b):
+            return F.relu(ops.batched_linear(x, w, b))
+        def linear3(x, w, b):
+            return ops.batched_linear(x, w, b)
+        return [conv1, conv2, linear1, linear2, linear3]
+
     def restore_models(self, args):
-        d = torch.load(args.resume)
-        self.mixer.load_state_dict(d['mixer']['state_dict'])
-        self.discriminator.load_state_dict(d['Dz']['state_dict'])
-        generators = self.generator.as_list()
-        for i, gen in enumerate(generators):
-            gen.load_state_dict(d['W{}'.format(i)]['state_dict'])
-
-
-    def save_models(self, args, metrics=None):
-        save_dict = {
-                'mixer': {'state_dict': self.mixer.state_dict()},
-                'W1': {'state_dict': self.generator.W1.state_dict()},
-                'W2': {'state_dict': self.generator.W2.state_dict()},
-                'W3': {'state_dict': self.generator.W3.state_dict()},
-                'W4': {'state_dict': self.generator.W4.state_dict()},
-                'W5': {'state_dict': self.generator.W5.state_dict()},
-                'netD': {'state_dict': self.discriminator.state_dict()}
-                }
+        d = checkpoint.load(checkpoint.resolve(args.resume), map_location=args.device)
+        checkpoint.load_model_state(self, d)
+
+
+    def save_models(self, args, metrics=None, worker=None):
         path = 'saved_models/mnist/lenet-{}-{}.pt'.format(args.exp, metrics)
-        torch.save(save_dict, path)
+        checkpoint.save_models(self, path, worker)
@@ -1,8 +1,12 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import ops
+import utils
+import checkpoint
 import itertools
-from .hypergan_base import HyperGAN_Base
+from .hypergan_base import HyperGAN_Base, Generators
+from . import layers
 
 
 """ MedNet Pytorch definition """
@@ -61,7 +65,7 @@ class GeneratorW1(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 32*3*3*3 + 32, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 32*3*3*3 + 32)
         if args.use_bn:
             self.bn1 = nn.BatchNorm1d(512)
             self.bn2 = nn.BatchNorm1d(512)
@@ -70,12 +74,18 @@ class GeneratorW1(nn.Module):
             self.bn2 = lambda x: x
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias and self.use_bn:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.relu(self.bn1(self.linear1(x)))
         x = F.relu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :32*3*3*3], x[:, -32:]
         w = w.view(-1, 32, 3, 3, 3)
@@ -90,7 +100,7 @@ class GeneratorW2(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 64*32*3*3+64, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 64*32*3*3+64)
         if args.use_bn:
             self.bn1 = nn.BatchNorm1d(512)
             self.bn2 = nn.BatchNorm1d(512)
@@ -99,12 +109,18 @@ class GeneratorW2(nn.Module):
             self.bn2 = lambda x: x
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias and self.use_bn:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         #x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.relu(self.bn1(self.linear1(x)))
         x = F.relu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :64*32*3*3], x[:, -64:]
         w = w.view(-1, 64, 32, 3, 3)
@@ -119,7 +135,7 @@ class GeneratorW3(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 64*64*3*3+64, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 64*64*3*3+64)
         if args.use_bn:
             self.bn1 = nn.BatchNorm1d(512)
             self.bn2 = nn.BatchNorm1d(512)
@@ -128,12 +144,18 @@ class GeneratorW3(nn.Module):
             self.bn2 = lambda x: x
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias and self.use_bn:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         #x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.relu(self.bn1(self.linear1(x)))
         x = F.relu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :64*64*3*3], x[:, -64:]
         w = w.view(-1, 64, 64, 3, 3)
@@ -148,7 +170,7 @@ class GeneratorW4(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 128*256+128, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 128*256+128)
         if args.use_bn:
             self.bn1 = nn.BatchNorm1d(512)
             self.bn2 = nn.BatchNorm1d(512)
@@ -157,12 +179,18 @@ class GeneratorW4(nn.Module):
             self.bn2 = lambda x: x
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias and self.use_bn:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         #x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.relu(self.bn1(self.linear1(x)))
         x = F.relu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :128*256], x[:, -128:]
         w = w.view(-1, 128, 256)
@@ -177,7 +205,7 @@ class GeneratorW5(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 10*128+10, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 10*128+10)
         if args.use_bn:
             self.bn1 = nn.BatchNorm1d(512)
             self.bn2 = nn.BatchNorm1d(512)
@@ -186,12 +214,18 @@ class GeneratorW5(nn.Module):
             self.bn2 = lambda x: x
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias and self.use_bn:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         #x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.relu(self.bn1(self.linear1(x)))
         x = F.relu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :10*128], x[:, -10:]
         w = w.view(-1, 10, 128)
@@ -223,37 +257,23 @@ class HyperGAN(HyperGAN_Base):
         super(HyperGAN, self).__init__(args)
         self.device = device
         self.mixer = Mixer(args).to(device)
-        self.generator = self.Generator(args, device)
+        self.generator = Generators(args, [GeneratorW1, GeneratorW2, GeneratorW3, GeneratorW4, GeneratorW5],
+                act=F.relu, target='mednet', device=device,
+                noise=[True, False, False, False, False], use_bn=args.use_bn)
         self.discriminator = DiscriminatorZ(args).to(device)
         self.model = MedNet().to(device)
         self.print_hypergan()
 
-    class Generator(object):
-        def __init__(self, args, device):
-            self.W1 = GeneratorW1(args).to(device)
-            self.W2 = GeneratorW2(args).to(device)
-            self.W3 = GeneratorW3(args).to(device)
-            self.W4 = GeneratorW4(args).to(device)
-            self.W5 = GeneratorW5(args).to(device)
-
-        def __call__(self, x):
-            w1, b1 = self.W1(x[0])
-            w2, b2 = self.W2(x[1])
-            w3, b3 = self.W3(x[2])
-            w4, b4 = self.W4(x[3])
-            w5, b5 = self.W5(x[4])
-            layers = [w1, b1, w2, b2, w3, b3, w4, b4, w5, b5]
-            return layers
-        
-        def as_list(self):
-            return [self.W1, self.W2, self.W3, self.W4, self.W5]
-
     def attach_optimizers(self, lr_m, lr_g, lr_d):
         self.optim_mixer = torch.optim.Adam(self.mixer.parameters(), lr=lr_m, weight_decay=1e-4)
         self.optim_disc = torch.optim.Adam(self.discriminator.parameters(), lr=lr_d, weight_decay=1e-4)
         
         #gen_params = [g.parameters() for g in self.generator.as_list()]
         #self.optim_generator = torch.optim.Adam(itertools.chain(*gen_params), lr=lr_g, weight_decay=1e-4)
+        if self.generator.fused is not None:
+            self.optim_generator = torch.optim.Adam(self.generator.fused.parameters(), lr=lr_g,
+                    weight_decay=1e-4, foreach=True)
+            return
         self.optim_w1 = torch.optim.Adam(self.generator.W1.parameters(), lr=lr_g, weight_decay=1e-4)
         self.optim_w2 = torch.optim.Adam(self.generator.W2.parameters(), lr=lr_g, weight_decay=1e-4)
         self.optim_w3 = torch.optim.Adam(self.generator.W3.parameters(), lr=lr_g, weight_decay=1e-4)
@@ -261,6 +281,9 @@ class HyperGAN(HyperGAN_Base):
         self.optim_w5 = torch.optim.Adam(self.generator.W5.parameters(), lr=lr_g, weight_decay=1e-4)
 
     def update_generator(self):
+        if self.generator.fused is not None:
+            self.optim_generator.step()
+            return
         self.optim_w1.step()
         self.optim_w2.step()
         self.optim_w3.step()
@@ -281,26 +304,34 @@ class HyperGAN(HyperGAN_Base):
         x = F.linear(x, w5, bias=b5)
         return x
 
+    # per-layer steps of the batched forward, each takes (x, w, b)
+    def batched_layers(self):
+        def conv(x, w, b):
+            x = F.relu(ops.batched_conv2d(x, w, b, stride=1))
+            return F.max_pool2d(x, 2, 2)
+        def fc1(x, w, b):
+            x = ops.batched_flatten(x, w.size(0))
+            return F.relu(ops.batched_linear(x, w, b))
+        def fc2(x, w, b):
+            return ops.batched_linear(x, w, b)
+        return [conv, conv, conv, fc1, fc2]
+
+    # all members in one pass, returns [members, batch, classes] logits
+    def eval_f_batched(self, Z, data):
+        return self.run_layers(self.batched_layers(), Z, data)
+
+    # layer-streaming pass, only one layer's weights alive at a time
+    def eval_f_streamed(self, codes, data, seed=None):
+        with utils.seeded(seed, codes.device):
+            return self.stream_layers(self.batched_layers(), codes, data)
+
     def restore_models(self, path):
-        d = torch.load(path)
-        self.mixer.load_state_dict(d['mixer']['state_dict'])
-        self.discriminator.load_state_dict(d['netD']['state_dict'])
-        generators = self.generator.as_list()
-        for i, gen in enumerate(generators):
-            gen.load_state_dict(d['W{}'.format(i+1)]['state_dict'])
-
-    def save_models(self, path, metrics=None):
-        save_dict = {
-                'mixer': {'state_dict': self.mixer.state_dict()},
-                'W1': {'state_dict': self.generator.W1.state_dict()},
-                'W2': {'state_dict': self.generator.W2.state_dict()},
-                'W3': {'state_dict': self.generator.W3.state_dict()},
-                'W4': {'state_dict': self.generator.W4.state_dict()},
-                'W5': {'state_dict': self.generator.W5.state_dict()},
-                'netD': {'state_dict': self.discriminator.state_dict()}
-                }
+        d = checkpoint.load(checkpoint.resolve(path), map_location=self.device)
+        checkpoint.load_model_state(self, d)
+
+    def save_models(self, path, metrics=None, worker=None):
         path = 'saved_models/mnist/mednet-{}-{}.pt'.format(path, metrics)
-        torch.save(save_dict, path)
+        checkpoint.save_models(self, path, worker)
 
     def print_hypergan(self):
         print (self.mixer)
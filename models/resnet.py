@@ -0,0 +1,94 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import ops
+import checkpoint
+from .hypergan_base import HyperGAN_Base, Generators
+from .mednet import Mixer, DiscriminatorZ
+
+
+""" ResNet14 Pytorch definition: 3 stages x 2 basic blocks, no normalization """
+class BasicBlock(nn.Module):
+    def __init__(self, in_c, out_c, stride=1):
+        super(BasicBlock, self).__init__()
+        self.a = nn.Conv2d(in_c, out_c, 3, stride=stride, padding=1)
+        self.b = nn.Conv2d(out_c, out_c, 3, padding=1)
+
+    def forward(self, x, skip):
+        x = F.relu(self.a(x))
+        return F.relu(self.b(x) + skip)
+
+
+class ResNet(nn.Module):
+    def __init__(self):
+        super(ResNet, self).__init__()
+        self.conv1 = nn.Conv2d(3, 16, 3, padding=1)
+        self.layer1 = nn.ModuleList([BasicBlock(16, 16), BasicBlock(16, 16)])
+        self.proj2 = nn.Conv2d(16, 32, 1, stride=2)
+        self.layer2 = nn.ModuleList([BasicBlock(16, 32, 2), BasicBlock(32, 32)])
+        self.proj3 = nn.Conv2d(32, 64, 1, stride=2)
+        self.layer3 = nn.ModuleList([BasicBlock(32, 64, 2), BasicBlock(64, 64)])
+        self.linear = nn.Linear(64, 10)
+
+    def forward(self, x):
+        x = F.relu(self.conv1(x))
+        for proj, blocks in [(None, self.layer1), (self.proj2, self.layer2), (self.proj3, self.layer3)]:
+            for i, block in enumerate(blocks):
+                skip = proj(x) if (proj is not None and i == 0) else x
+                x = block(x, skip)
+        x = F.adaptive_avg_pool2d(x, 1).view(x.size(0), -1)
+        return self.linear(x)
+
+
+class HyperGAN(HyperGAN_Base):
+
+    def __init__(self, args):
+        super(HyperGAN, self).__init__(args)
+        self.mixer = Mixer(args).to(args.device)
+        """ too many parameters for per-layer or fused generators, always use the chunked one """
+        if args.fused_gen:
+            raise ValueError('resnet only supports the chunked generator (--gen_chunk)')
+        if args.gen_chunk <= 0:
+            args.gen_chunk = 4096
+        self.generator = Generators(args, [])
+        self.discriminator = DiscriminatorZ(args).to(args.device)
+        self.model = ResNet().to(args.device)
+
+    """ per-layer steps of the batched forward, state is (x, skip) """
+    def batched_layers(self, args):
+        def stem(x, w, b):
+            x = F.relu(ops.batched_conv2d(x, w, b, padding=1))
+            return (x, x)
+        def conv_a(stride):
+            def step(state, w, b):
+                x, skip = state
+                return (F.relu(ops.batched_conv2d(x, w, b, stride=stride, padding=1)), skip)
+            return step
+        def conv_b(state, w, b):
+            x, skip = state
+            x = F.relu(ops.batched_conv2d(x, w, b, padding=1) + skip)
+            return (x, x)
+        def proj(state, w, b):
+            x, skip = state
+            return (x, ops.batched_conv2d(skip, w, b, stride=2))
+        def linear(state, w, b):
+            x = F.adaptive_avg_pool2d(state[0], 1)
+            x = ops.batched_flatten(x, w.size(0))
+            return ops.batched_linear(x, w, b)
+        block = [conv_a(1), conv_b]
+        return ([stem] + block * 2 +
+                [proj, conv_a(2), conv_b] + block +
+                [proj, conv_a(2), conv_b] + block + [linear])
+
+    """ functional model for training """
+    def eval_f(self, args, Z, data):
+        return self.eval_f_batched(args, [p.unsqueeze(0) for p in Z], data)[0]
+
+    def restore_models(self, args):
+        d = checkpoint.load(checkpoint.resolve(args.resume), map_location=args.device)
+        checkpoint.load_model_state(self, d)
+
+
+    def save_models(self, args, metrics=None, worker=None):
+        path = 'saved_models/cifar/resnet-{}-{}.pt'.format(args.exp, metrics)
+        checkpoint.save_models(self, path, worker)
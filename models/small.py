@@ -1,7 +1,10 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .hypergan_base import HyperGAN_Base
+import ops
+import checkpoint
+from .hypergan_base import HyperGAN_Base, Generators
+from . import layers
 
 
 """ class model of target network for testing """
@@ -57,16 +60,22 @@ class GeneratorW1(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 800 + 32, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 800 + 32)
         self.bn1 = nn.BatchNorm1d(512)
         self.bn2 = nn.BatchNorm1d(512)
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if self.bias:
             self.bn1.bias.data.zero_()
         x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.elu(self.bn1(self.linear1(x)))
         x = F.elu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :800], x[:, -32:]
         w = w.view(-1, 32, 1, 5, 5)
@@ -80,17 +89,23 @@ class GeneratorW2(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 25600+32, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 25600+32)
         self.bn1 = nn.BatchNorm1d(512)
         self.bn2 = nn.BatchNorm1d(512)
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.elu(self.bn1(self.linear1(x)))
         x = F.elu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :25600], x[:, -32:]
         w = w.view(-1, 32, 32, 5, 5)
@@ -105,17 +120,23 @@ class GeneratorW3(nn.Module):
             setattr(self, k, v)
         self.linear1 = nn.Linear(self.z, 512, bias=self.bias)
         self.linear2 = nn.Linear(512, 512, bias=self.bias)
-        self.linear3 = nn.Linear(512, 512*10+10, bias=self.bias)
+        self.linear3 = layers.head(args, 512, 512*10+10)
         self.bn1 = nn.BatchNorm1d(512)
         self.bn2 = nn.BatchNorm1d(512)
 
     def forward(self, x):
+        return self.head(self.trunk(x))
+
+    def trunk(self, x):
         if not self.bias:
             self.bn1.bias.data.zero_()
             self.bn2.bias.data.zero_()
         x = torch.zeros_like(x).normal_(0, 0.01) + x
         x = F.elu(self.bn1(self.linear1(x)))
         x = F.elu(self.bn2(self.linear2(x)))
+        return x
+
+    def head(self, x):
         x = self.linear3(x)
         w, b = x[:, :512*10], x[:, -10:]
         w = w.view(-1, 10, 512)
@@ -146,26 +167,10 @@ class HyperGAN(HyperGAN_Base):
     def __init__(self, args):
         super(HyperGAN, self).__init__(args)
         self.mixer = Mixer(args).to(args.device)
-        self.generator = self.Generator(args)
+        self.generator = Generators(args, [GeneratorW1, GeneratorW2, GeneratorW3], act=F.elu)
         self.discriminator = DiscriminatorZ(args).to(args.device)
         self.model = Small().to(args.device)
 
-    class Generator(object):
-        def __init__(self, args):
-            self.W1 = GeneratorW1(args).to(args.device)
-            self.W2 = GeneratorW2(args).to(args.device)
-            self.W3 = GeneratorW3(args).to(args.device)
-
-        def __call__(self, x):
-            w1, b1 = self.W1(x[0])
-            w2, b2 = self.W2(x[1])
-            w3, b3 = self.W3(x[2])
-            layers = [w1, b1, w2, b2, w3, b3]
-            return layers
-        
-        def as_list(self):
-            return [self.W1, self.W2, self.W3]
-
     """ functional model for training """
     def eval_f(self, args, Z, data):
         w1, b1 = Z[:2]
@@ -181,22 +186,24 @@ class HyperGAN(HyperGAN_Base):
         x = F.linear(x, w3, bias=b3)
         return x
 
+    """ per-layer steps of the batched forward, each takes (x, w, b) """
+    def batched_layers(self, args):
+        def conv1(x, w, b):
+            x = F.leaky_relu(ops.batched_conv2d(x, w, b, stride=1))
+            return F.max_pool2d(x, 2, 2)
+        def conv2(x, w, b):
+            x = F.leaky_relu(ops.batched_conv2d(x, w, b, stride=1))
+            return F.max_pool2d(x, 2, 2)
+        def linear(x, w, b):
+            x = ops.batched_flatten(x, w.size(0))
+            return ops.batched_linear(x, w, b)
+        return [conv1, conv2, linear]
+
     def restore_models(self, args):
-        d = torch.load(args.resume)
-        self.mixer.load_state_dict(d['mixer']['state_dict'])
-        self.discriminator.load_state_dict(d['Dz']['state_dict'])
-        generators = self.generator.as_list()
-        for i, gen in enumerate(generators):
-            gen.load_state_dict(d['W{}'.format(i)]['state_dict'])
-
-
-    def save_models(self, args, metrics=None):
-        save_dict = {
-                'mixer': {'state_dict': self.mixer.state_dict()},
-                'W1': {'state_dict': self.generator.W1.state_dict()},
-                'W2': {'state_dict': self.generator.W2.state_dict()},
-                'W3': {'state_dict': self.generator.W3.state_dict()},
-                'netD': {'state_dict': self.discriminator.state_dict()}
-                }
+        d = checkpoint.load(checkpoint.resolve(args.resume), map_location=args.device)
+        checkpoint.load_model_state(self, d)
+
+
+    def save_models(self, args, metrics=None, worker=None):
         path = 'saved_models/mnist/small-{}-{}.pt'.format(args.exp, metrics)
-        torch.save(save_dict, path)
+        checkpoint.save_models(self, path, worker)
@@ -5,27 +5,61 @@ def nets():
             'n_layers': 3,
             'layer_names': ['conv1.0', 'conv2.0', 'linear'],
             'shapes': [(32, 1, 5, 5), (32, 32, 5, 5), (10, 512)],
-            'base_shape': 5
+            'base_shape': 5,
+            'input_shape': (1, 28, 28),
+            'ops': [{'op': 'conv', 'act': 'leaky_relu', 'pool': 2},
+                    {'op': 'conv', 'act': 'leaky_relu', 'pool': 2},
+                    {'op': 'linear', 'flatten': True}],
+            'generator_act': 'elu'
             }
     networks['small3'] = {
             'name': 'Small3',
             'n_layers': 5,
             'layer_names': ['conv1.0', 'conv2.0', 'linear1', 'linear2'],
             'shapes': [(32, 1, 5, 5), (32, 64, 5, 5), (1024, 1024), (10, 1024)],
-            'base_shape': 5
+            'base_shape': 5,
+            'input_shape': (1, 28, 28)
             }
     networks['lenet'] = { 
             'name': 'LeNet',
             'n_layers': 5, 
             'layer_names': ['conv1', 'conv2', 'linear1', 'linear2', 'linear3'],
-            'shapes': [(6, 3, 5, 5), (16, 6, 5, 5), (120, 400), (84, 120), (10, 84)],
-            'base_shape': 5
+            'shapes': [(6, 1, 5, 5), (16, 6, 5, 5), (120, 400), (84, 120), (10, 84)],
+            'base_shape': 5,
+            'input_shape': (1, 28, 28),
+            'ops': [{'op': 'conv', 'padding': 2, 'act': 'relu', 'pool': 2},
+                    {'op': 'conv', 'act': 'relu', 'pool': 2},
+                    {'op': 'linear', 'flatten': True, 'act': 'relu'},
+                    {'op': 'linear', 'act': 'relu'},
+                    {'op': 'linear'}]
             }
     networks['mednet'] = { 
             'name': 'MedNet',
             'n_layers': 5, 
             'layer_names': ['conv1', 'conv2', 'conv3', 'fc1', 'fc2'],
-            'shapes': [(16, 3, 3, 3), (32, 16, 3, 3), (32, 32, 3, 3), (64, 128), (10, 64)],
-            'base_shape': 3
+            'shapes': [(32, 3, 3, 3), (64, 32, 3, 3), (64, 64, 3, 3), (128, 256), (10, 128)],
+            'base_shape': 3,
+            'input_shape': (3, 32, 32),
+            'ops': [{'op': 'conv', 'act': 'relu', 'pool': 2},
+                    {'op': 'conv', 'act': 'relu', 'pool': 2},
+                    {'op': 'conv', 'act': 'relu', 'pool': 2},
+                    {'op': 'linear', 'flatten': True, 'act': 'relu'},
+                    {'op': 'linear'}]
+            }
+    networks['resnet'] = {
+            'name': 'ResNet14',
+            'n_layers': 16,
+            'layer_names': ['conv1',
+                'layer1.0.a', 'layer1.0.b', 'layer1.1.a', 'layer1.1.b',
+                'layer2.proj', 'layer2.0.a', 'layer2.0.b', 'layer2.1.a', 'layer2.1.b',
+                'layer3.proj', 'layer3.0.a', 'layer3.0.b', 'layer3.1.a', 'layer3.1.b',
+                'linear'],
+            'shapes': [(16, 3, 3, 3),
+                (16, 16, 3, 3), (16, 16, 3, 3), (16, 16, 3, 3), (16, 16, 3, 3),
+                (32, 16, 1, 1), (32, 16, 3, 3), (32, 32, 3, 3), (32, 32, 3, 3), (32, 32, 3, 3),
+                (64, 32, 1, 1), (64, 32, 3, 3), (64, 64, 3, 3), (64, 64, 3, 3), (64, 64, 3, 3),
+                (10, 64)],
+            'base_shape': 3,
+            'input_shape': (3, 32, 32)
             }
     return networks
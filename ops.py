@@ -1,15 +1,21 @@
+import os
 import math
 import torch
 import torch.nn.functional as F
 import torch.autograd as autograd
 
+import checkpoint
 
-def pretrain_encoder(args, mixer, optimM):
+
+def pretrain_encoder(args, mixer, optimM, analytic=False):
     for enc_iter in range(1000):
         s = torch.randn(1000, args.s).to(args.device)
-        codes = mixer(s).view(args.z*args.ngen, 1000).transpose(0, 1)
-        full_z = torch.randn(1000, args.z*args.ngen).to(args.device)
-        mean_loss, cov_loss = pretrain_loss(codes, full_z)
+        if analytic:
+            mean_loss, cov_loss = analytic_pretrain_loss(mixer(s))
+        else:
+            codes = mixer(s).view(args.z*args.ngen, 1000).transpose(0, 1)
+            full_z = torch.randn(1000, args.z*args.ngen).to(args.device)
+            mean_loss, cov_loss = pretrain_loss(codes, full_z)
         loss = mean_loss + cov_loss
         loss.backward()
         optimM.step()
@@ -34,6 +40,54 @@ def pretrain_loss(encoded, noise):
     return mean_loss, cov_loss
 
 
+def analytic_pretrain_loss(codes):
+    """
+    codes [ngen, N, z] against the known N(0, I) moments, all codes in one batch
+    no target samples are drawn: the target mean is 0 and the covariance is I
+    """
+    n = codes.size(1)
+    mean = codes.mean(1, keepdim=True)
+    centered = codes - mean
+    cov = torch.bmm(centered.transpose(1, 2), centered) / (n - 1)
+    eye = torch.eye(codes.size(2), device=codes.device).expand_as(cov)
+    mean_loss = mean.pow(2).mean()
+    cov_loss = F.mse_loss(cov, eye)
+    return mean_loss, cov_loss
+
+
+def pretrain_cache_path(args, mixer, cache_dir, seed, analytic):
+    """ one pretrained mixer per (s, z, ngen, bias, seed), and per mixer/objective """
+    name = 'mixer-{}-s{}-z{}-ngen{}-bias{}-seed{}-{}.pt'.format(
+            type(mixer).__module__.split('.')[-1], args.s, args.z, args.ngen,
+            int(bool(args.bias)), seed, 'analytic' if analytic else 'sampled')
+    return os.path.join(cache_dir, name)
+
+
+def cached_pretrain_encoder(args, mixer, optimM, cache_dir, seed, analytic=False, pretrain=None):
+    """
+    load a pretrained mixer if a launch with the same key made one
+    pretrain() runs on a miss, by default ops.pretrain_encoder on mixer/optimM.
+    an entry holds the mixer, its optimizer and the RNG state pretraining left,
+    so training after a hit is the same as after a miss
+    """
+    if pretrain is None:
+        pretrain = lambda: pretrain_encoder(args, mixer, optimM, analytic)
+    if not cache_dir:
+        return pretrain()
+    path = pretrain_cache_path(args, mixer, cache_dir, seed, analytic)
+    if os.path.exists(path):
+        entry = checkpoint.load(path)
+        if 'optimizer' in entry:
+            mixer.load_state_dict(entry['mixer'])
+            optimM.load_state_dict(entry['optimizer'])
+            checkpoint.set_rng_state(entry['rng'])
+            print ('Loaded pretrained encoder from {}'.format(path))
+            return
+        """ mixer-only entry from an older launch: pretrain again and replace it """
+    pretrain()
+    checkpoint.save(path, {'mixer': mixer.state_dict(), 'optimizer': optimM.state_dict(),
+        'rng': checkpoint.rng_state()})
+
 
 def log_density(z, z_var):
     z_dim = z.size(1)
@@ -41,16 +95,142 @@ def log_density(z, z_var):
     return z
 
 
+_adversary_constants = {}
+
+
+def adversary_constants(n_real, n_fake, device):
+    """
+    labels and the constant log-density offset of the adversary losses
+    they only depend on (batch_size, ngen, device), so build them once
+    """
+    key = (n_real, n_fake, str(device))
+    if key not in _adversary_constants:
+        _adversary_constants[key] = {
+                'ones': torch.ones(n_real, 1, device=device),
+                'zeros': torch.zeros(n_fake, 1, device=device),
+                'one_qz': torch.ones(n_fake, 1, device=device),
+                'log_qz': log_density(torch.ones(n_fake, 1), 2).view(-1, 1).to(device),
+                }
+    return _adversary_constants[key]
+
+
 def calc_d_loss(args, Dz, z, codes, cifar=False):
-    log_pz = log_density(z, 2).view(-1, 1).to(args.device)
-    dim = args.batch_size * args.ngen
-    zeros = torch.zeros(dim, 1, requires_grad=True).to(args.device)
-    ones = torch.ones(args.batch_size, 1, requires_grad=True).to(args.device)
-    d_z = Dz(z)
+    """ prior samples and codes go through Dz in one fused forward """
     codes = codes.view(-1, args.z)
-    d_codes = Dz(codes)
-    log_pz_ = log_density(torch.ones(dim, 1), 2).view(-1, 1).to(args.device)
-    d_loss = F.binary_cross_entropy_with_logits(d_z+log_pz, ones) + \
-             F.binary_cross_entropy_with_logits(d_codes+log_pz_, zeros)
+    n_real = z.size(0)
+    const = adversary_constants(n_real, codes.size(0), z.device)
+    log_pz = log_density(z, 2).view(-1, 1)
+    d_out = Dz(torch.cat([z, codes]))
+    d_z, d_codes = d_out[:n_real], d_out[n_real:]
+    d_loss = F.binary_cross_entropy_with_logits(d_z+log_pz, const['ones']) + \
+             F.binary_cross_entropy_with_logits(d_codes+const['log_qz'], const['zeros'])
     total_loss = d_loss
     return total_loss, d_codes
+
+
+def calc_q_loss(args, Dz, codes):
+    """ Q(s) wants its codes scored as prior samples; call with Dz frozen """
+    codes = codes.view(-1, args.z)
+    const = adversary_constants(args.ensemble_size, codes.size(0), codes.device)
+    d_q = Dz(codes)
+    return F.binary_cross_entropy_with_logits(d_q+const['log_qz'], const['one_qz'])
+
+
+""" 
+batched functional ops for evaluating a whole generated ensemble in one pass
+activations of M members are stacked along the channel dim: [B, M*C, H, W]
+after flattening they are member-major: [M, B, F]
+"""
+def batched_conv2d(x, w, b, **kwargs):
+    members, out_c = w.size(0), w.size(1)
+    weight = w.contiguous().view(members*out_c, *w.shape[2:])
+    bias = b.contiguous().view(-1) if b is not None else None
+    if x.size(1) == w.size(2):
+        """ shared input: one wide conv, no need to replicate the data """
+        return F.conv2d(x, weight, bias=bias, **kwargs)
+    return F.conv2d(x, weight, bias=bias, groups=members, **kwargs)
+
+
+def batched_flatten(x, members):
+    return x.view(x.size(0), members, -1).transpose(0, 1)
+
+
+def batched_linear(x, w, b):
+    if b is None:
+        return torch.bmm(x, w.transpose(1, 2))
+    return torch.baddbmm(b.unsqueeze(1), x, w.transpose(1, 2))
+
+
+def shard_members(data, target, members):
+    """
+    split one batch across members: member m gets rows [m*b, (m+1)*b)
+    data comes back as [b, M*C, H, W], so the first batched conv runs grouped
+    over the members' own inputs, target as [M, b]
+    """
+    b = data.size(0) // members
+    data = data[:members*b].view(members, b, *data.shape[1:]).transpose(0, 1)
+    data = data.reshape(b, members*data.size(2), *data.shape[3:])
+    return data, target[:members*b].view(members, b)
+
+
+def ensemble_clf_loss(out, target):
+    """
+    sum over members of the per-member mean cross entropy, [M, B, C] logits
+    target is [B] when members share the batch, [M, B] when it is sharded
+    """
+    members, batch = out.size(0), out.size(1)
+    if target.dim() == 1:
+        target = target.view(1, -1).expand(members, -1)
+    loss = F.cross_entropy(out.reshape(members*batch, -1), target.reshape(-1),
+            reduction='sum') / batch
+    pred = out.detach().max(2)[1]
+    correct = pred.eq(target).long().sum(1)
+    return loss, correct
+
+
+def evaluate_ensemble(args, hypergan, loader, metrics, members=None):
+    """
+    metrics of one fixed ensemble over a whole loader, call under no_grad
+    codes and weights are sampled once and every batch goes through them;
+    --stream_eval regenerates one layer at a time per batch, from the same
+    codes and a per-pass seed, so every batch still sees the same weights
+    """
+    members = members or args.ensemble_size
+    s = torch.randn(members, args.s).to(args.device)
+    codes = hypergan.mixer(s)
+    seed = int(torch.randint(2**31 - 1, ()).item())
+    params = None if args.stream_eval else hypergan.generator(codes)
+    for data, target in loader:
+        data = data.to(args.device)
+        target = target.to(args.device)
+        if params is None:
+            out = hypergan.eval_f_streamed(args, codes, data, seed)
+        elif args.batched_eval:
+            out = hypergan.eval_f_batched(args, params, data)
+        else:
+            out = torch.stack([hypergan.eval_f(args, layers, data) for layers in zip(*params)])
+        metrics.update(out, target)
+    return metrics.summary()
+
+
+def chunked_clf_loss(args, hypergan, codes, data, target, chunk):
+    """
+    classifier loss over the ensemble, generated and evaluated chunk members at a time
+    the generator trunks run once for all members (BatchNorm stats are unchanged),
+    each chunk's heads + eval_f graph is backpropagated and freed immediately.
+    gradients reach the heads directly and the trunks/mixer through the returned
+    surrogate, whose gradient equals that of the full-pass G loss
+    """
+    feats = hypergan.generator.trunk(codes)
+    leaves = [f.detach().requires_grad_() for f in feats]
+    members = codes.size(1)
+    clf_loss, corrects = 0., []
+    for start in range(0, members, chunk):
+        params = hypergan.generator.head(leaves, slice(start, start+chunk))
+        out = hypergan.eval_f_batched(args, params, data)
+        loss, correct = ensemble_clf_loss(out, target)
+        (loss / args.ensemble_size).backward()
+        clf_loss += loss.detach()
+        corrects.append(correct)
+    surrogate = sum((f * leaf.grad).sum() for f, leaf in zip(feats, leaves))
+    return surrogate, clf_loss, torch.cat(corrects)
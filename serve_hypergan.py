@@ -0,0 +1,259 @@
+"""
+local ensemble prediction server
+restores a trained HyperGAN, generates a fixed set of members once, and
+answers newline-delimited JSON requests over a local socket
+concurrent requests are coalesced into micro-batches under a latency deadline
+each answer carries the mean prediction, predictive entropy and member disagreement
+
+    python3 serve_hypergan.py --target small --resume saved_models/mnist/small-0-0.9.pt
+    python3 serve_hypergan.py --target small --bench 2000 --concurrency 32
+
+request:  {"id": 0, "x": [C, H, W] or [k, C, H, W] nested lists}
+response: {"id": 0, "label": [k], "pred": [k, classes], "entropy": [k], "disagreement": [k]}
+"""
+import os
+import json
+import time
+import argparse
+import asyncio
+import importlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn.functional as F
+
+import netdef
+
+
+""" bytes of a JSON float32 (sign, digits, exponent, separator), sizes the request line limit """
+JSON_VALUE_BYTES = 32
+
+def load_args():
+
+    parser = argparse.ArgumentParser(description='HyperGAN ensemble server')
+    parser.add_argument('--z', default=64, type=int, help='Q(z|s) latent space width')
+    parser.add_argument('--s', default=256, type=int, help='S sample dimension')
+    parser.add_argument('--bias', action='store_true', help='Include HyperGAN bias')
+    parser.add_argument('--batch_size', default=100, type=int, help='generation batch size')
+    parser.add_argument('--target', default='small', type=str, help='target name')
+    parser.add_argument('--exp', default='0', type=str)
+    parser.add_argument('--resume', default=None, type=str, help='checkpoint to serve')
+    parser.add_argument('--bank', default=None, type=str, help='serve members from a weight bank')
+    parser.add_argument('--members', default=100, type=int, help='ensemble size to cache')
+    parser.add_argument('--fused_gen', action='store_true', help='single fused generator for all layers')
+    parser.add_argument('--head_rank', default=0, type=int, help='low-rank generator output heads (0: full)')
+    parser.add_argument('--gen_chunk', default=0, type=int, help='shared chunked generator emitting chunks of this size (0: off)')
+    parser.add_argument('--netdef', action='store_true', help='build the target from its netdef.nets() ops instead of models/<target>.py')
+    parser.add_argument('--torchscript', action='store_true', help='run the netdef-compiled forward as TorchScript')
+    parser.add_argument('--socket', default='hypergan.sock', type=str, help='unix socket path')
+    parser.add_argument('--port', default=None, type=int, help='serve on localhost:port instead')
+    parser.add_argument('--max_batch', default=64, type=int, help='max images per micro-batch')
+    parser.add_argument('--max_delay', default=5., type=float, help='micro-batch deadline (ms)')
+    parser.add_argument('--bench', default=0, type=int, help='run a load test with this many requests')
+    parser.add_argument('--concurrency', default=16, type=int, help='open connections for --bench')
+    parser.add_argument('--cuda', action='store_true')
+    args = parser.parse_args()
+    return args
+
+
+class EnsemblePredictor(object):
+    """ holds a cached set of generated members and scores batches with them """
+    def __init__(self, args):
+        args.ngen = len(netdef.nets()[args.target]['shapes'])
+        if args.netdef:
+            models = importlib.import_module('models.compiled')
+        else:
+            models = importlib.import_module('models.{}'.format(args.target))
+        self.args = args
+        self.hypergan = models.HyperGAN(args)
+        if args.resume is not None:
+            self.hypergan.restore_models(args)
+        """ compiled targets score bank rows as they are stored, sliced inside the forward """
+        self.flat = args.bank is not None and hasattr(self.hypergan, 'eval_f_flat')
+        with torch.no_grad():
+            if self.flat:
+                members = [self.hypergan.load_bank(args.bank).rows(slice(0, args.members))]
+            elif args.bank is not None:
+                members = self.hypergan.load_bank(args.bank)[:args.members]
+            else:
+                members = self.generate(args.members)
+        self.members = [p.to(args.device) for p in members]
+
+    def generate(self, n):
+        chunks = []
+        while sum(c[0].size(0) for c in chunks) < n:
+            s = torch.randn(max(self.args.batch_size, 2), self.args.s).to(self.args.device)
+            codes = self.hypergan.mixer(s)
+            chunks.append([p.detach() for p in self.hypergan.generator(codes)])
+        return [torch.cat(layer)[:n] for layer in zip(*chunks)]
+
+    def __call__(self, x):
+        with torch.no_grad():
+            x = x.to(self.args.device)
+            if self.flat:
+                out = self.hypergan.eval_f_flat(self.args, self.members[0], x)
+            else:
+                out = self.hypergan.eval_f_batched(self.args, self.members, x)
+            probs = F.softmax(out, 2)
+            mean = probs.mean(0)
+            entropy = -(mean * torch.log(mean.clamp_min(1e-12))).sum(1)
+            label = mean.max(1)[1]
+            votes = probs.max(2)[1]
+            disagreement = votes.ne(label.view(1, -1)).float().mean(0)
+        return label.cpu(), mean.cpu(), entropy.cpu(), disagreement.cpu()
+
+
+class MicroBatcher(object):
+    """ coalesces concurrent requests until max_batch images or the deadline """
+    def __init__(self, predict, max_batch, max_delay):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_delay = max_delay / 1000.
+        self.queue = asyncio.Queue()
+        """ one compute thread keeps the event loop free while a batch runs """
+        self.executor = ThreadPoolExecutor(1)
+
+    async def submit(self, x):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((x, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            n = batch[0][0].size(0)
+            deadline = loop.time() + self.max_delay
+            while n < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(item)
+                n += item[0].size(0)
+            x = torch.cat([item[0] for item in batch])
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict, x)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for x, future in batch:
+                end = start + x.size(0)
+                if not future.cancelled():
+                    future.set_result([r[start:end] for r in results])
+                start = end
+
+
+def line_limit(max_batch, input_shape):
+    """ stream limit that fits a request of max_batch inputs """
+    return max_batch * int(np.prod(input_shape)) * JSON_VALUE_BYTES + 2**16
+
+
+async def handle(batcher, input_shape, limit, reader, writer):
+    while True:
+        overrun = False
+        try:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                """ the rest of an over-long line cannot be told from the next request """
+                overrun = True
+                raise ValueError('request longer than {} bytes'.format(limit))
+            if not line:
+                break
+            request = json.loads(line)
+            x = torch.tensor(request['x'], dtype=torch.float32)
+            if x.dim() == len(input_shape):
+                x = x.unsqueeze(0)
+            if tuple(x.shape[1:]) != tuple(input_shape):
+                raise ValueError('expected input of shape {}'.format(list(input_shape)))
+            label, pred, entropy, disagreement = await batcher.submit(x)
+            response = {
+                    'id': request.get('id'),
+                    'label': label.tolist(),
+                    'pred': pred.tolist(),
+                    'entropy': entropy.tolist(),
+                    'disagreement': disagreement.tolist(),
+                    }
+        except Exception as e:
+            response = {'error': str(e)}
+        writer.write((json.dumps(response) + '\n').encode('utf-8'))
+        await writer.drain()
+        if overrun:
+            break
+    writer.close()
+
+
+async def open_connection(args):
+    if args.port is not None:
+        return await asyncio.open_connection('127.0.0.1', args.port)
+    return await asyncio.open_unix_connection(args.socket)
+
+
+async def serve(args):
+    predictor = EnsemblePredictor(args)
+    batcher = MicroBatcher(predictor, args.max_batch, args.max_delay)
+    input_shape = netdef.nets()[args.target]['input_shape']
+    limit = line_limit(args.max_batch, input_shape)
+    client = lambda r, w: handle(batcher, input_shape, limit, r, w)
+    if args.port is not None:
+        server = await asyncio.start_server(client, '127.0.0.1', args.port, limit=limit)
+        where = '127.0.0.1:{}'.format(args.port)
+    else:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = await asyncio.start_unix_server(client, args.socket, limit=limit)
+        where = args.socket
+    print ('==> serving {} members of {} on {}'.format(
+        predictor.members[0].size(0), args.target, where))
+    async with server:
+        await asyncio.gather(server.serve_forever(), batcher.run())
+
+
+async def bench(args):
+    """ load test a running server, report p50/p99 latency and requests/sec """
+    input_shape = netdef.nets()[args.target]['input_shape']
+    latencies = []
+    per_client = [args.bench // args.concurrency] * args.concurrency
+    per_client[0] += args.bench - sum(per_client)
+
+    async def client(n):
+        reader, writer = await open_connection(args)
+        for i in range(n):
+            x = np.random.randn(*input_shape).astype(np.float32).tolist()
+            start = time.perf_counter()
+            writer.write((json.dumps({'id': i, 'x': x}) + '\n').encode('utf-8'))
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            if 'error' in response:
+                raise RuntimeError(response['error'])
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(n) for n in per_client])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000.
+    print ('requests: {}, concurrency: {}'.format(len(latencies), args.concurrency))
+    print ('p50: {:.2f} ms, p99: {:.2f} ms'.format(
+        np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    print ('throughput: {:.1f} requests/sec'.format(len(latencies) / elapsed))
+
+
+if __name__ == '__main__':
+    args = load_args()
+    if args.cuda and torch.cuda.is_available():
+        args.device = 'cuda'
+    else:
+        args.device = 'cpu'
+    if args.bench > 0:
+        asyncio.run(bench(args))
+    else:
+        asyncio.run(serve(args))
@@ -6,6 +6,7 @@ by defaut, weight posteriors are plotted, though this can be safely commented ou
 import matplotlib
 matplotlib.use('agg')
 import sys
+import time
 import torch
 import pprint
 import argparse
@@ -14,8 +15,12 @@ import importlib
 
 import ops
 import utils
+import netdef
 import datagen
 import experiments
+import workers
+import evaluation
+import checkpoint
 
 import torch
 import torch.optim
@@ -28,16 +33,50 @@ def load_args():
     parser.add_argument('--s', default=256, type=int, help='S sample dimension')
     parser.add_argument('--bias', action='store_true', help='Include HyperGAN bias')
     parser.add_argument('--batch_size', default=100, type=int, help='network batch size')
+    parser.add_argument('--ensemble_size', default=0, type=int, help='networks generated per step (0: batch_size)')
+    parser.add_argument('--member_subsample', default=0, type=int, help='classification loss on k random members per step (0: all)')
+    parser.add_argument('--reuse_weights', default=1, type=int, help='data batches per generated ensemble (one Q/G update each)')
+    parser.add_argument('--log_interval', default=0, type=int, help='print train metrics every n batches (0: once per epoch)')
+    parser.add_argument('--shard_data', default=0, type=int, help='give every member its own n training images per step (0: shared batch, implies --batched_eval)')
     parser.add_argument('--epochs', default=200000, type=int)
     parser.add_argument('--target', default='small', type=str, help='target name')
     parser.add_argument('--beta', default=1, type=int, help='lagrangian strength')
+    parser.add_argument('--n_critic', default=1, type=int, help='discriminator steps per generator step')
+    parser.add_argument('--single_graph', action='store_true', help='D on detached codes, Q/G through a frozen D, every graph freed by its one backward')
     parser.add_argument('--pretrain_e', action='store_true')
+    parser.add_argument('--pretrain_analytic', action='store_true', help='pretrain Q(s) against the analytic N(0, I) moments')
+    parser.add_argument('--pretrain_cache', default='saved_models/pretrain', type=str, help='pretrained mixer cache dir (empty: off)')
+    parser.add_argument('--seed', default=1, type=int)
     parser.add_argument('--exp', default='0', type=str)
-    parser.add_argument('--resume', default=None, type=str, help='resume from path')
+    parser.add_argument('--resume', default=None, type=str, help='resume from a checkpoint file or the latest one in a --ckpt_dir')
+    parser.add_argument('--ckpt_dir', default='', type=str, help='directory for resumable training checkpoints (empty: off)')
+    parser.add_argument('--ckpt_interval', default=1000, type=int, help='optimizer steps between training checkpoints')
+    parser.add_argument('--keep_last', default=3, type=int, help='training checkpoints to keep besides best.pt (0: all)')
     parser.add_argument('--lr', default=1e-4, type=float, help='learning rate')
     parser.add_argument('--wd', default=5e-4, type=float, help='weight decay (optimizer)')
     parser.add_argument('--cuda', action='store_true')
     parser.add_argument('--dataset', default='mnist', type=str, help='mnist, cifar, cifar_hidden')
+    parser.add_argument('--batched_eval', action='store_true', help='evaluate all generated networks in one pass')
+    parser.add_argument('--fused_gen', action='store_true', help='single fused generator for all layers')
+    parser.add_argument('--head_rank', default=0, type=int, help='low-rank generator output heads (0: full)')
+    parser.add_argument('--gen_chunk', default=0, type=int, help='shared chunked generator emitting chunks of this size (0: off)')
+    parser.add_argument('--async_side_effects', action='store_true', help='plot and checkpoint on a background thread')
+    parser.add_argument('--side_queue', default=2, type=int, help='max pending background jobs')
+    parser.add_argument('--member_chunk', default=0, type=int, help='generate/evaluate this many members at a time (0: all)')
+    parser.add_argument('--stream_eval', action='store_true', help='generate and apply one layer at a time at test time')
+    parser.add_argument('--in_memory', action='store_true', help='hold the dataset as a tensor, batch by slicing')
+    parser.add_argument('--classes', default='0,1,2,3,4', type=str, help='cifar_hidden training classes')
+    parser.add_argument('--test_classes', default=None, type=str, help='cifar_hidden test classes (default: --classes)')
+    parser.add_argument('--netdef', action='store_true', help='build the target from its netdef.nets() ops instead of models/<target>.py')
+    parser.add_argument('--torchscript', action='store_true', help='run the netdef-compiled forward as TorchScript')
+    parser.add_argument('--compile', action='store_true', help='torch.compile mixer, generators and the batched forward (implies --batched_eval)')
+    parser.add_argument('--eval_samples', default=0, type=int, help='test examples per subsampled evaluation (0: full test set)')
+    parser.add_argument('--eval_fraction', default=0., type=float, help='size subsampled evaluations to this fraction of wall-clock (0: off)')
+    parser.add_argument('--eval_confidence', default=0.95, type=float, help='confidence level of subsampled evaluation intervals')
+    parser.add_argument('--eval_interval', default=1, type=int, help='epochs between test evaluations')
+    parser.add_argument('--async_eval', action='store_true', help='evaluate parameter snapshots in a separate process')
+    parser.add_argument('--eval_threads', default=0, type=int, help='torch threads of the async eval process (0: default)')
+    parser.add_argument('--compile_cache', default='.compile_cache', type=str, help='on-disk cache for compiled artifacts')
     args = parser.parse_args()
     return args
 
@@ -47,91 +86,253 @@ def set_ngen(args):
         args.ngen = 3
     elif args.target in ['lenet', 'mednet']: 
         args.ngen = 5
+    elif args.target in netdef.nets():
+        args.ngen = len(netdef.nets()[args.target]['shapes'])
     else:
         raise ValueError
     return
 
 
+def report_snapshot(args, stats):
+    """ a result of the async eval process, for the snapshot published at stats['epoch'] """
+    print ('[snapshot {}] Test Accuracy: {}, Test Loss: {}, Ensemble Accuracy: {}{}'.format(
+        stats['epoch'], stats['acc'], stats['loss'], stats['ensemble_acc'],
+        ', new best (saved)' if stats['best'] else ''))
+    args.best_acc, args.best_loss = stats['best_acc'], stats['best_loss']
+
+
 def train(args):
-    torch.manual_seed(1)
+    torch.manual_seed(args.seed)
     set_ngen(args)
-    models = importlib.import_module('models.{}'.format(args.target))
+    if args.netdef:
+        models = importlib.import_module('models.compiled')
+    else:
+        models = importlib.import_module('models.{}'.format(args.target))
     if args.cuda and torch.cuda.is_available():
         args.device = 'cuda'
     else:
         args.device = 'cpu'
 
+    if args.member_subsample > 0 and args.member_chunk > 0:
+        raise ValueError('--member_subsample and --member_chunk are exclusive')
+    if args.reuse_weights > 1 and args.member_chunk > 0:
+        raise ValueError('--reuse_weights and --member_chunk are exclusive')
+    if args.shard_data > 0:
+        if args.member_chunk > 0:
+            raise ValueError('--shard_data and --member_chunk are exclusive')
+        args.batched_eval = True
+    if args.async_eval and (args.eval_samples > 0 or args.eval_fraction > 0):
+        raise ValueError('--async_eval always runs full evaluations, drop --eval_samples / --eval_fraction')
     """ instantiate HyperGAN """
     hypergan = models.HyperGAN(args)
     generator = hypergan.generator
     mixer = hypergan.mixer
     Dz = hypergan.discriminator
-    if args.resume is not None:
-        hypergan.restore_models()
     print (mixer, generator.as_list(), Dz)
+    if args.compile:
+        """ the per-member eval_f loop is the dispatch overhead we compile away """
+        args.batched_eval = True
+        utils.compile_hypergan(args, hypergan, args.compile_cache)
     
     """ attach optimizers """
     optimQ = torch.optim.Adam(mixer.parameters(), lr=args.lr, weight_decay=args.wd)
     optimW = []
-    for m in range(args.ngen):
-        s = getattr(generator, 'W{}'.format(m+1))
-        optimW.append(torch.optim.Adam(s.parameters(), lr=args.lr, weight_decay=args.wd))
+    if generator.fused is not None:
+        optimW.append(torch.optim.Adam(generator.fused.parameters(), lr=args.lr,
+            weight_decay=args.wd, foreach=True))
+    else:
+        for m in range(args.ngen):
+            s = getattr(generator, 'W{}'.format(m+1))
+            optimW.append(torch.optim.Adam(s.parameters(), lr=args.lr, weight_decay=args.wd))
     optimD = torch.optim.Adam(Dz.parameters(), lr=args.lr, weight_decay=args.wd)
     schedulers = []
     steps = [10*i for i in range(1, 100)]
     for op in [optimQ, optimD, *optimW]:
         schedulers.append(utils.CyclicCosAnnealingLR(op, steps, eta_min=1e-8))
     best_test_acc, best_test_loss, = 0., np.inf
+    start_epoch, start_batch, resume_rng, epoch_rng = 0, 0, None, None
+    global_step = 0
+    if args.resume is not None:
+        path = checkpoint.resolve(args.resume)
+        state = checkpoint.load(path)
+        if 'optimizers' in state:
+            checkpoint.load_training_state(state, hypergan, optimQ, optimD, optimW, schedulers)
+            start_epoch, start_batch = state['position']['epoch'], state['position']['batch']
+            global_step = state['position'].get('global_step', 0)
+            best_test_acc, best_test_loss = state['best']['acc'], state['best']['loss']
+            resume_rng, epoch_rng = state['rng'], state['epoch_rng']
+            print ('==> resuming {} at epoch {}, batch {}'.format(path, start_epoch, start_batch))
+        else:
+            """ model weights only: a new run starting from them """
+            checkpoint.load_model_state(hypergan, state)
+        del state
     args.best_loss, args.best_acc = best_test_loss, best_test_acc
 
-    trainset, testset = getattr(datagen, 'load_{}'.format(args.dataset))()
+    data_kwargs = {'in_memory': args.in_memory, 'device': args.device}
+    if args.dataset == 'cifar_hidden':
+        data_kwargs['c_idx'] = [int(c) for c in args.classes.split(',')]
+        if args.test_classes is not None:
+            data_kwargs['test_idx'] = [int(c) for c in args.test_classes.split(',')]
+    trainset, testset = getattr(datagen, 'load_{}'.format(args.dataset))(**data_kwargs)
+    args.data_kwargs = data_kwargs
+    if args.shard_data > 0:
+        """ one batch holds a shard for every member that is evaluated """
+        members = args.member_subsample or args.ensemble_size
+        trainset = datagen.rebatch(trainset, args.shard_data * members)
+    worker = None
+    if args.async_side_effects:
+        worker = workers.SideEffectWorker(args.side_queue)
+    manager = None
+    if args.ckpt_dir:
+        manager = checkpoint.CheckpointManager(args.ckpt_dir, args.keep_last, worker)
 
-    if args.pretrain_e is True:
+    if args.pretrain_e is True and args.resume is None:
        print ("==> pretraining encoder")
-       ops.pretrain_encoder(args, mixer, optimQ)
+       ops.cached_pretrain_encoder(args, mixer, optimQ, args.pretrain_cache,
+               args.seed, args.pretrain_analytic)
        
-    getattr(experiments, 'sample_weight_posteriors_{}'.format(args.target))(args, hypergan, 0)
+    experiments.sample_weight_posteriors(args, hypergan, 0, worker)
+    """ metrics stay on the device, read back once per epoch / log interval """
+    train_metrics = utils.EnsembleMetrics(args.device)
+    test_metrics = utils.EnsembleMetrics(args.device, moments=True)
+    evaluator = evaluation.EvalScheduler(args, hypergan, testset, test_metrics)
+    eval_process = None
+    if args.async_eval:
+        eval_process = workers.EvalProcess(args, evaluation.SnapshotEvaluator, hypergan)
     print ('==> Begin Training')
-    for epoch in range(args.epochs):
-        for batch_idx, (data, target) in enumerate(trainset):
-            """ Update discriminator on each sample from Q(z|s) """
-            s = torch.randn(args.batch_size, args.s).to(args.device)
-            z = torch.randn(args.batch_size, args.z).to(args.device)
-            full_z = torch.randn(args.z*args.ngen, args.batch_size)
-            codes = mixer(s)
-            d_loss, d_q = ops.calc_d_loss(args, Dz, z, codes)
-            d_loss = d_loss * args.beta
-            optimD.zero_grad()
-            d_loss.backward(retain_graph=True)
-            optimD.step()
-
-            """ generate weights ~ G(Q(s)) """
-            params = generator(codes)
+    """ a run resumed at the end of an epoch trains no batch before the epoch report """
+    QG_loss = d_loss = torch.tensor(float('nan'))
+    for epoch in range(start_epoch, args.epochs):
+        epoch_start, steps, images = time.perf_counter(), 0, 0
+        n_batches = len(trainset)
+        mid_epoch = epoch == start_epoch and start_batch > 0
+        if mid_epoch:
+            """ replay the interrupted epoch's shuffle order, skipping to the checkpoint by index """
+            checkpoint.set_rng_state(epoch_rng)
+            batches = enumerate(datagen.skip_batches(trainset, start_batch), start_batch)
+        if resume_rng is not None:
+            checkpoint.set_rng_state(resume_rng)
+            resume_rng = None
+        if not mid_epoch:
+            """ the loader draws its shuffle order from this state """
+            if manager is not None:
+                epoch_rng = checkpoint.rng_state()
+            batches = enumerate(trainset)
+        for batch_idx, (data, target) in batches:
+            if batch_idx % args.reuse_weights == 0:
+                """ one generated ensemble serves the next group of data batches """
+                group = min(args.reuse_weights, n_batches - batch_idx)
+                """ Update discriminator on each sample from Q(z|s) """
+                s = torch.randn(args.ensemble_size, args.s).to(args.device)
+                codes = mixer(s)
+                for critic in range(args.n_critic):
+                    """ extra critic steps reuse the codes, fresh prior samples each """
+                    z = torch.randn(args.ensemble_size, args.z).to(args.device)
+                    if args.single_graph:
+                        """ D only sees detached codes, its graph is freed by this backward """
+                        d_loss, _ = ops.calc_d_loss(args, Dz, z, codes.detach())
+                    else:
+                        """ live codes: the mixer also takes the D loss gradient, its graph is kept for Q/G """
+                        d_loss, _ = ops.calc_d_loss(args, Dz, z, codes)
+                    d_loss = d_loss * args.beta
+                    optimD.zero_grad()
+                    d_loss.backward(retain_graph=not args.single_graph)
+                    if critic < args.n_critic - 1 or not args.single_graph:
+                        optimD.step()
+                if args.single_graph:
+                    """ Q scores codes against the same (pre-step) D, without D gradients """
+                    with utils.frozen(Dz):
+                        Q_loss = ops.calc_q_loss(args, Dz, codes)
+                else:
+                    """ Q against the stepped D; D gets gradients here too, cleared before its next step """
+                    Q_loss = ops.calc_q_loss(args, Dz, codes)
+
+                if args.member_chunk == 0:
+                    """ generate weights ~ G(Q(s)) """
+                    if args.member_subsample > 0:
+                        """ every member through the trunks (BatchNorm stats), k random heads """
+                        idx = torch.randperm(args.ensemble_size, device=codes.device)
+                        params = generator.head(generator.trunk(codes), idx[:args.member_subsample])
+                    else:
+                        params = generator(codes)
+                    eval_params = params
+                    if args.reuse_weights > 1:
+                        """ per-batch graphs end at detached copies, the generator graph is kept once """
+                        eval_params = [p.detach().requires_grad_() for p in params]
+                        clf_total = 0.
+
             """ eval weights on target architecture (training set) """
             clf_loss = 0.
             data = data.to(args.device)
             target = target.to(args.device)
-            for (layers) in zip(*params):
-                out = hypergan.eval_f(args, layers, data)
-                loss = F.cross_entropy(out, target)
-                pred = out.data.max(1, keepdim=True)[1]
-                acc = pred.eq(target.data.view_as(pred)).long().cpu().sum()
-                clf_loss += loss
+            images += data.size(0)
+            if args.member_chunk > 0:
+                """ generate and evaluate weights ~ G(Q(s)) a chunk of members at a time """
+                surrogate, clf_loss, correct = ops.chunked_clf_loss(
+                        args, hypergan, codes, data, target, args.member_chunk)
+                train_metrics.add(clf_loss, correct, correct.size(0), data.size(0))
+            else:
+                if args.shard_data > 0:
+                    """ member m trains on its own slice of the batch """
+                    data, target = ops.shard_members(data, target, eval_params[0].size(0))
+                if args.batched_eval:
+                    out = hypergan.eval_f_batched(args, eval_params, data)
+                    clf_loss, correct = ops.ensemble_clf_loss(out, target)
+                    train_metrics.update(out, target, clf_loss, correct)
+                else:
+                    outs = []
+                    for (layers) in zip(*eval_params):
+                        out = hypergan.eval_f(args, layers, data)
+                        loss = F.cross_entropy(out, target)
+                        outs.append(out.detach())
+                        clf_loss += loss
+                    train_metrics.update(torch.stack(outs), target, clf_loss)
+                if args.member_subsample > 0:
+                    """ rescale to an unbiased estimate of the full-ensemble sum """
+                    clf_loss = clf_loss * (args.ensemble_size / float(params[0].size(0)))
+                if args.reuse_weights > 1:
+                    """ grads land on the detached weights, this batch's graph is freed """
+                    (clf_loss / (args.ensemble_size * group)).backward()
+                    clf_total += clf_loss.detach()
+
+            if (batch_idx + 1) % args.reuse_weights != 0 and batch_idx + 1 < n_batches:
+                continue
 
             """ calculate total loss on Q and G """
-            one_qz = torch.ones((args.batch_size*args.ngen, 1), requires_grad=True).to(args.device)
-            log_qz = ops.log_density(torch.ones(args.batch_size*args.ngen, 1), 2).view(-1, 1).to(args.device)
-            Q_loss = F.binary_cross_entropy_with_logits(d_q+log_qz, one_qz)
-            G_loss = clf_loss / args.batch_size
+            if args.reuse_weights > 1:
+                G_loss = clf_total / (args.ensemble_size * group)
+                """ push the accumulated weight grads through generators and mixer """
+                surrogate = sum((p * leaf.grad).sum() for p, leaf in zip(params, eval_params))
+            else:
+                G_loss = clf_loss / args.ensemble_size
             QG_loss = Q_loss + G_loss
-            QG_loss.backward()
-            
+            if args.member_chunk > 0 or args.reuse_weights > 1:
+                """ head grads are already in, push the rest through trunks and mixer """
+                (Q_loss + surrogate).backward()
+            else:
+                QG_loss.backward()
+
+            if args.single_graph:
+                """ last D step only now: the Q graph above still holds its weights """
+                optimD.step()
             optimQ.step()
             for optim in optimW:
                 optim.step()
             optimQ.zero_grad()
             for optim in optimW:
                 optim.zero_grad()
+            steps += 1
+            global_step += 1
+            if manager is not None and global_step % args.ckpt_interval == 0:
+                manager.save(checkpoint.training_state(hypergan, optimQ, optimD, optimW, schedulers,
+                    epoch, batch_idx + 1, {'acc': best_test_acc, 'loss': best_test_loss}, epoch_rng,
+                    global_step))
+            if args.log_interval > 0 and (batch_idx + 1) % args.log_interval == 0:
+                """ running epoch numbers, the epoch report below resets them """
+                stats = train_metrics.summary(reset=False)
+                print ('Epoch: {} [{}/{}] Train Acc: {:.4f}, Train Loss: {:.4f}, Ensemble Acc: {}'.format(
+                    epoch, batch_idx + 1, n_batches, stats['acc'], stats['loss'], stats['ensemble_acc']))
+        elapsed = time.perf_counter() - epoch_start
         
         for scheduler in schedulers:
             scheduler.step()
@@ -139,43 +340,58 @@ def train(args):
         """ print training accuracy """
         print ('**************************************')
         print ('Epoch: {}'.format(epoch))
-        print ('Train Acc: {}, G Loss: {}, D loss: {}'.format(acc, QG_loss, d_loss))
+        stats = train_metrics.summary()
+        print ('Train Acc: {}, Ensemble Acc: {}, G Loss: {}, D loss: {}'.format(
+            stats['acc'], stats['ensemble_acc'], QG_loss.item(), d_loss.item()))
+        print ('Throughput: {:.2f} steps/sec, {:.1f} images/sec'.format(
+            steps / elapsed, images / elapsed))
         print ('best test loss: {}'.format(args.best_loss))
         print ('best test acc: {}'.format(args.best_acc))
         print ('**************************************')
                         
-        """ test random draw on testing set """
-        test_acc = 0.
-        test_loss = 0.
-        with torch.no_grad():
-            for i, (data, target) in enumerate(testset):
-                data = data.to(args.device)
-                target = target.to(args.device)
-                s = torch.randn(args.s, args.batch_size).to(args.device)
-                codes = mixer(s)
-                params = generator(codes)
-                
-                for (layers) in zip(*params):
-                    out = hypergan.eval_f(args, layers, data)
-                    loss = F.cross_entropy(out, target)
-                    pred = out.data.max(1, keepdim=True)[1]
-                    correct = pred.eq(target.data.view_as(pred)).long().cpu().sum()
-                    test_acc += correct.item()
-                    test_loss += loss.item()
-
-            test_loss /= len(testset.dataset) * args.batch_size
-            test_acc /= len(testset.dataset) * args.batch_size
-            print ('Test Accuracy: {}, Test Loss: {}'.format(test_acc, test_loss))
-            if test_loss < best_test_loss:
-                best_test_loss, args.best_loss = test_loss, test_loss
-            if test_acc > best_test_acc:
-                hypergan.save_models(args, test_acc)
-            if test_acc > best_test_acc:
-                best_test_acc, args.best_acc = test_acc, test_acc
-        """ plot weight posteriors """
-        getattr(experiments, 'sample_weight_posteriors_{}'.format(args.target))(args, hypergan, epoch)
+        if epoch % args.eval_interval == 0 and eval_process is not None:
+            """ hand the current weights to the eval process and keep training """
+            eval_process.publish(hypergan, epoch)
+        elif epoch % args.eval_interval == 0:
+            """ test one random ensemble, drawn once, on (a budgeted subset of) the testing set """
+            stats = evaluator(best_test_acc)
+            test_loss, test_acc = stats['loss'], stats['acc']
+            if not stats['full']:
+                print ('Test Accuracy: {:.4f} +- {:.4f}, Test Loss: {:.4f} +- {:.4f} ({}/{} examples, below best)'.format(
+                    test_acc, stats['acc_ci'], test_loss, stats['loss_ci'], stats['examples'], evaluator.total))
+            else:
+                print ('Test Accuracy: {}, Test Loss: {}, Ensemble Accuracy: {}, Ensemble Loss: {}'.format(
+                    test_acc, test_loss, stats['ensemble_acc'], stats['ensemble_loss']))
+                if test_loss < best_test_loss:
+                    best_test_loss, args.best_loss = test_loss, test_loss
+                if test_acc > best_test_acc:
+                    hypergan.save_models(args, test_acc, worker)
+                if test_acc > best_test_acc:
+                    best_test_acc, args.best_acc = test_acc, test_acc
+                    if manager is not None:
+                        manager.save(checkpoint.training_state(hypergan, optimQ, optimD, optimW, schedulers,
+                            epoch + 1, 0, {'acc': best_test_acc, 'loss': best_test_loss},
+                            global_step=global_step), best=True)
+            if args.eval_samples > 0 or args.eval_fraction > 0:
+                print ('Eval: {} full / {} subsampled, {:.1f}s total'.format(
+                    evaluator.full_evals, evaluator.subset_evals, evaluator.eval_time))
+            """ plot weight posteriors """
+            experiments.sample_weight_posteriors(args, hypergan, epoch, worker)
+        if eval_process is not None:
+            for stats in eval_process.poll():
+                report_snapshot(args, stats)
+                """ training checkpoints carry the eval process's best """
+                best_test_acc, best_test_loss = stats['best_acc'], stats['best_loss']
         
-       
+    if eval_process is not None:
+        for stats in eval_process.close():
+            report_snapshot(args, stats)
+        print ('Snapshots: {} of {} published evaluated, {} skipped while the eval process was busy'.format(
+            eval_process.evaluated, eval_process.published, eval_process.skipped))
+    if worker is not None:
+        worker.close()
+        
+
 if __name__ == '__main__':
     args = load_args()
     train(args)
@@ -1,12 +1,15 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.nn.init as init
 import torch.distributions.multivariate_normal as N
 import torch.distributions.uniform as U
 from torch.optim.lr_scheduler import _LRScheduler
 from torch.optim.optimizer import Optimizer
 
+import os
 import math
+import contextlib
 import numpy as np
 from bisect import bisect_right,bisect_left
 
@@ -63,3 +66,148 @@ class CyclicCosAnnealingLR(_LRScheduler):
         return [self.eta_min + (base_lr - self.eta_min) *
                (1 + math.cos(math.pi * curr_pos/ width)) / 2
                 for base_lr in self.base_lrs]
+
+
+def cpu_snapshot(obj):
+    """ detached CPU copy of a (nested) state dict, safe to hand to another thread """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+@contextlib.contextmanager
+def seeded(seed, device='cpu'):
+    """ run a block on a forked RNG seeded with seed; None runs it on the global RNG """
+    if seed is None:
+        yield
+        return
+    device = torch.device(device)
+    devices = [device.index or 0] if device.type == 'cuda' else []
+    with torch.random.fork_rng(devices=devices):
+        torch.manual_seed(seed)
+        yield
+
+
+@contextlib.contextmanager
+def frozen(module):
+    """ forward through module without building gradients for its parameters """
+    params = [p for p in module.parameters() if p.requires_grad]
+    for p in params:
+        p.requires_grad_(False)
+    try:
+        yield module
+    finally:
+        for p in params:
+            p.requires_grad_(True)
+
+
+def compile_cache(path):
+    """ keep inductor/AOTAutograd artifacts on disk so later launches skip codegen """
+    path = os.path.abspath(path)
+    os.makedirs(path, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', path)
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, 'autograd_cache'):
+        inductor_config.autograd_cache = True
+    return os.environ['TORCHINDUCTOR_CACHE_DIR']
+
+
+def compile_hypergan(args, hypergan, cache='.compile_cache'):
+    """
+    torch.compile the mixer, the generators and the batched forward in place
+    modules are compiled with nn.Module.compile, so parameters, optimizers and
+    state_dict keys are untouched; the forward is wrapped once per instance.
+    called unbound, since the models copy every arg (args.compile included)
+    onto themselves as attributes
+    """
+    if cache:
+        compile_cache(cache)
+    nn.Module.compile(hypergan.mixer, dynamic=False)
+    for gen in hypergan.generator.as_list():
+        nn.Module.compile(gen, dynamic=False)
+    eval_f_batched = torch.compile(hypergan.eval_f_batched, dynamic=False)
+    hypergan.eval_f_batched = eval_f_batched
+    return hypergan
+
+
+class EnsembleMetrics(object):
+    """
+    running loss / correct / count tensors kept on the compute device
+    per-member metrics average over every (member, example) pair, ensemble
+    metrics use the members' mean softmax; nothing is read back to the host
+    until summary(), so the loops never block on the device
+    with moments=True the per-example (member averaged) accuracy and loss
+    second moments are kept too, for confidence intervals on subsampled evals
+    """
+    def __init__(self, device='cpu', moments=False):
+        self.device = device
+        self.moments = moments
+        self.reset()
+
+    def reset(self):
+        self.sums = torch.zeros(6, dtype=torch.float64, device=self.device)
+        self.pairs = 0
+        self.examples = 0
+
+    def update(self, out, target, loss=None, correct=None):
+        """
+        out: [M, B, C] logits, target: [B] shared or [M, B] sharded
+        loss / correct: per-member summed mean CE and [M] correct counts, if
+        the caller already has them
+        """
+        out = out.detach()
+        members, batch = out.size(0), out.size(1)
+        with torch.no_grad():
+            targets = target.view(1, -1).expand(members, -1) if target.dim() == 1 else target
+            if loss is None:
+                loss = F.cross_entropy(out.reshape(members*batch, -1), targets.reshape(-1),
+                        reduction='sum') / batch
+            if correct is None:
+                correct = out.max(2)[1].eq(targets).long().sum(1)
+            self.sums[0] += loss.detach() * batch
+            self.sums[1] += correct.sum()
+            if target.dim() == 1:
+                """ the ensemble prediction only exists when members share the batch """
+                log_prob = torch.logsumexp(F.log_softmax(out, 2), 0) - math.log(members)
+                self.sums[2] += log_prob.max(1)[1].eq(target).sum()
+                self.sums[3] += F.nll_loss(log_prob, target, reduction='sum')
+                self.examples += batch
+                if self.moments:
+                    example_acc = out.max(2)[1].eq(targets).double().mean(0)
+                    example_loss = F.cross_entropy(out.reshape(members*batch, -1), targets.reshape(-1),
+                            reduction='none').view(members, batch).double().mean(0)
+                    self.sums[4] += example_acc.pow(2).sum()
+                    self.sums[5] += example_loss.pow(2).sum()
+        self.pairs += members * batch
+
+    def add(self, loss, correct, members, batch):
+        """ per-member sums from a loss that never materializes all logits """
+        with torch.no_grad():
+            self.sums[0] += loss.detach() * batch
+            self.sums[1] += correct.sum()
+        self.pairs += members * batch
+
+    def summary(self, reset=True):
+        """ the one host sync: mean loss / accuracy per member and for the ensemble """
+        loss, correct, ens_correct, ens_loss, acc_sq, loss_sq = self.sums.tolist()
+        pairs, examples = max(self.pairs, 1), max(self.examples, 1)
+        stats = {
+                'loss': loss / pairs,
+                'acc': correct / pairs,
+                'ensemble_loss': ens_loss / examples if self.examples else None,
+                'ensemble_acc': ens_correct / examples if self.examples else None,
+                'examples': self.examples,
+                }
+        if self.moments and self.examples > 1:
+            """ sample std over examples of the member averaged accuracy / loss """
+            n = self.examples
+            stats['acc_std'] = math.sqrt(max(acc_sq - n * stats['acc']**2, 0.) / (n - 1))
+            stats['loss_std'] = math.sqrt(max(loss_sq - n * stats['loss']**2, 0.) / (n - 1))
+        if reset:
+            self.reset()
+        return stats
@@ -0,0 +1,157 @@
+import sys
+import queue
+import threading
+import traceback
+import collections
+import torch
+import torch.multiprocessing as mp
+
+import checkpoint
+
+
+"""
+background worker for side effects (plots, checkpoints) so training never
+waits on matplotlib or disk. jobs must only touch detached CPU snapshots.
+the queue is bounded: a job submitted with a key replaces a pending job with
+the same key (the newest snapshot wins), otherwise a full queue skips the job
+"""
+class SideEffectWorker(threading.Thread):
+    def __init__(self, maxsize=2):
+        super(SideEffectWorker, self).__init__(daemon=True)
+        self.maxsize = maxsize
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.closing = False
+        self.dropped = 0
+        self.replaced = 0
+        self.start()
+
+    def submit(self, fn, *args, key=None):
+        with self.cond:
+            if key is not None:
+                for i, (k, _, _) in enumerate(self.pending):
+                    if k == key:
+                        self.pending[i] = (key, fn, args)
+                        self.replaced += 1
+                        return True
+            if len(self.pending) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self.pending.append((key, fn, args))
+            self.cond.notify()
+            return True
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closing:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                key, fn, args = self.pending.popleft()
+            try:
+                fn(*args)
+            except Exception:
+                print ('side effect {} failed'.format(key), file=sys.stderr)
+                traceback.print_exc()
+
+    def close(self):
+        """ finish the pending jobs and stop """
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.join()
+
+
+def _eval_loop(args, factory, buffers, free, requests, results):
+    """ eval process: load the published snapshot, release the buffers, evaluate it """
+    try:
+        evaluator = factory(args)
+        modules = checkpoint.modules(evaluator.hypergan)
+        while True:
+            epoch = requests.get()
+            if epoch is None:
+                break
+            for name, state in buffers.items():
+                modules[name].load_state_dict(state)
+            free.set()
+            results.put(evaluator(epoch))
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+    finally:
+        results.put(None)
+
+
+"""
+evaluation in a separate local process, so the test pass, posterior sampling
+and best-checkpoint bookkeeping overlap with training. module state lives in
+shared-memory CPU tensors allocated once; publish() copies the current weights
+into them and returns immediately, the process copies them out into its own
+HyperGAN before releasing the buffers, so every result (and checkpoint) belongs
+to exactly the snapshot that was evaluated. a snapshot published while the
+previous one is still being copied out is skipped; publishing to a process
+that has exited raises.
+factory(args) runs in the process and returns a callable epoch -> stats dict
+with a .hypergan; it must be importable (spawn context, also safe with CUDA)
+"""
+class EvalProcess(object):
+    def __init__(self, args, factory, hypergan):
+        ctx = mp.get_context('spawn')
+        self.buffers = {}
+        for name, module in checkpoint.modules(hypergan).items():
+            self.buffers[name] = {k: v.detach().cpu().clone().share_memory_()
+                    for k, v in module.state_dict().items()}
+        self.free = ctx.Event()
+        self.free.set()
+        self.requests = ctx.Queue()
+        self.results = ctx.Queue()
+        self.published = 0
+        self.evaluated = 0
+        self.skipped = 0
+        self.done = False
+        self.process = ctx.Process(target=_eval_loop,
+                args=(args, factory, self.buffers, self.free, self.requests, self.results))
+        self.process.start()
+
+    def publish(self, hypergan, epoch):
+        """ False if the previous snapshot is still being copied out """
+        if self.done or not self.process.is_alive():
+            raise RuntimeError('eval process has exited (exit code {}), cannot evaluate epoch {}'.format(
+                self.process.exitcode, epoch))
+        if not self.free.is_set():
+            self.skipped += 1
+            return False
+        self.free.clear()
+        with torch.no_grad():
+            for name, module in checkpoint.modules(hypergan).items():
+                for k, v in module.state_dict().items():
+                    self.buffers[name][k].copy_(v)
+        self.requests.put(epoch)
+        self.published += 1
+        return True
+
+    def poll(self, block=False):
+        """ results that arrived so far; block waits until the process has exited """
+        results = []
+        while not self.done:
+            try:
+                result = self.results.get(block=block, timeout=1. if block else None)
+            except queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                break
+            if result is None:
+                self.done = True
+                break
+            results.append(result)
+        self.evaluated += len(results)
+        return results
+
+    def close(self):
+        """ evaluate what was already published, then stop; returns the last results """
+        if not self.done:
+            self.requests.put(None)
+        results = self.poll(block=True)
+        self.process.join()
+        return results